@@ -0,0 +1,97 @@
+import os
+import struct
+import threading
+from pathlib import Path
+from filepool import FilePool
+
+
+class BlobStore:
+    # Content-addressed store of leaves packed into append-only segment files, each leaf is written
+    # after its digest and length so the index (digest -> where it is) can be rebuilt by scanning the segments
+    segmentsize = 256 * 1024 * 1024
+    header = struct.Struct("!32sI")
+
+    def __init__(self, directory, filepool=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.filepool = FilePool() if filepool is None else filepool
+        self.lock = threading.Lock()
+        # digest -> (segment filename, offset, length)
+        self.index = {}
+        self.segment = None
+        self.file = None
+        self.size = 0
+        self.load()
+
+    def segmentname(self, number):
+        return str(self.directory / f"{number:08d}.segment")
+
+    def load(self):
+        numbers = sorted(int(path.stem) for path in self.directory.glob("*.segment"))
+        for number in numbers:
+            filename = self.segmentname(number)
+            with open(filename, "rb") as file:
+                end = os.fstat(file.fileno()).st_size
+                offset = 0
+                while offset + self.header.size <= end:
+                    key, length = self.header.unpack(file.read(self.header.size))
+                    if offset + self.header.size + length > end:
+                        # partly written leaf (e.g. the daemon was killed), it is overwritten by the next one
+                        break
+                    self.index[key] = (filename, offset + self.header.size, length)
+                    offset += self.header.size + length
+                    self.size += self.header.size + length
+                    file.seek(offset)
+            if number == numbers[-1]:
+                self.segment = number
+                self.file = open(filename, "r+b")
+                self.file.truncate(offset)
+                self.file.seek(offset)
+        if self.file is None:
+            self._nextsegment()
+
+    def _nextsegment(self):
+        if self.file is not None:
+            self.file.close()
+        self.segment = 0 if self.segment is None else self.segment + 1
+        self.file = open(self.segmentname(self.segment), "w+b")
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.index:
+                return
+            if self.file.tell() > 0 and self.file.tell() + self.header.size + len(data) > self.segmentsize:
+                self._nextsegment()
+            offset = self.file.tell() + self.header.size
+            self.file.write(self.header.pack(key, len(data)))
+            self.file.write(data)
+            # written out so it can be read through a memory map straight away
+            self.file.flush()
+            self.index[key] = (self.file.name, offset, len(data))
+            self.size += self.header.size + len(data)
+
+    def get(self, key):
+        # A zero-copy view of the leaf (or None if it isn't stored)
+        location = self.index.get(key)
+        if location is None:
+            return None
+        return self.filepool.read(*location)
+
+    def discard(self, key):
+        # the space isn't reclaimed, the leaf just can't be found any more
+        with self.lock:
+            self.index.pop(key, None)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def stats(self):
+        with self.lock:
+            return {"blobs": len(self.index), "segments": self.segment + 1, "bytes": self.size}
@@ -0,0 +1,104 @@
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ChunkCache:
+    # Downloaded leaves kept in memory up to maxbytes, once over budget the least recently used
+    # are moved to a spill file on disk (instead of being dropped) and read back from there when needed.
+    # If given a blob store, leaves are written straight to it and served from it when not in memory
+    def __init__(self, maxbytes=256 * 1024 * 1024, directory=None, store=None):
+        self.maxbytes = maxbytes
+        self.directory = directory
+        self.store = store
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.size = 0
+        # key -> (offset, length) in the spill file
+        self.spilled = {}
+        self.spillfile = None
+        self.spillsize = 0
+        self.hits = 0
+        self.diskhits = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.memory or key in self.spilled or (self.store is not None and key in self.store)
+
+    def __len__(self):
+        with self.lock:
+            if self.store is not None:
+                return len(self.store)
+            return len(self.memory.keys() | self.spilled.keys())
+
+    def add(self, key, data):
+        with self.lock:
+            if key in self.memory:
+                return
+            if self.store is not None:
+                self.store.put(key, data)
+            self._insert(key, bytes(data))
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.hits += 1
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            if self.store is not None and key in self.store:
+                # served as a view of the memory mapped store, the page cache keeps it in memory if needed
+                self.diskhits += 1
+                return self.store.get(key)
+            if key not in self.spilled:
+                return None
+            self.diskhits += 1
+            offset, length = self.spilled[key]
+            self.spillfile.seek(offset)
+            data = self.spillfile.read(length)
+            # back in memory as it is being used again, it doesn't need writing out a second time
+            self._insert(key, data)
+            return data
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.size -= len(self.memory.pop(key))
+            # space in the spill file isn't reclaimed
+            self.spilled.pop(key, None)
+            if self.store is not None:
+                self.store.discard(key)
+
+    def _insert(self, key, data):
+        self.memory[key] = data
+        self.size += len(data)
+        while self.size > self.maxbytes and len(self.memory) > 1:
+            evictedkey, evicted = self.memory.popitem(last=False)
+            self.size -= len(evicted)
+            if self.store is None and evictedkey not in self.spilled:
+                self._spill(evictedkey, evicted)
+
+    def _spill(self, key, data):
+        if self.spillfile is None:
+            self.spillfile = tempfile.TemporaryFile(prefix="rafdpspill", dir=self.directory)
+        self.spillfile.seek(self.spillsize)
+        self.spillfile.write(data)
+        self.spilled[key] = (self.spillsize, len(data))
+        self.spillsize += len(data)
+
+    def close(self):
+        with self.lock:
+            self.memory.clear()
+            self.spilled.clear()
+            self.size = 0
+            if self.spillfile is not None:
+                self.spillfile.close()
+                self.spillfile = None
+                self.spillsize = 0
+
+    def stats(self):
+        with self.lock:
+            stats = {"memory": len(self.memory), "bytes": self.size, "maxbytes": self.maxbytes, "spilled": len(self.spilled),
+                     "spillbytes": self.spillsize, "hits": self.hits, "diskhits": self.diskhits}
+        if self.store is not None:
+            stats.update({"store" + key: value for key, value in self.store.stats().items()})
+        return stats
@@ -0,0 +1,77 @@
+import time
+
+
+class CongestionWindow:
+    # Limits how many requests can be outstanding to a peer at once, the window
+    # grows and shrinks like TCP (slow start, then AIMD) and the retransmission
+    # timeout is estimated from round trip times as in RFC 6298
+    initialwindow = 4
+    minwindow = 1
+    maxwindow = 1024
+    initialrto = 1
+    minrto = 0.05
+    maxrto = 30
+
+    def __init__(self):
+        self.window = self.initialwindow
+        self.ssthresh = self.maxwindow
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.initialrto
+        self.outstanding = {}
+        self.retransmits = set()
+        self.lastdecrease = 0
+        # Round trip time measured by the last acknowledged request (None if it was retransmitted)
+        self.lastsample = None
+
+    def can_send(self):
+        return len(self.outstanding) < int(self.window)
+
+    def on_send(self, key):
+        # Karn's algorithm: round trip times aren't measured for retransmitted requests
+        retransmitted = key in self.retransmits
+        self.retransmits.discard(key)
+        self.outstanding[key] = (time.monotonic(), retransmitted)
+
+    def on_ack(self, key):
+        if key not in self.outstanding:
+            return False
+        senttime, retransmitted = self.outstanding.pop(key)
+        self.lastsample = None
+        if not retransmitted:
+            self.lastsample = time.monotonic() - senttime
+            self.sample_rtt(self.lastsample)
+        if self.window < self.ssthresh:
+            self.window += 1
+        else:
+            self.window += 1 / self.window
+        self.window = min(self.window, self.maxwindow)
+        return True
+
+    def release(self, key):
+        # Stop waiting for a request without counting it as lost (e.g. another peer answered it)
+        self.retransmits.discard(key)
+        return self.outstanding.pop(key, None) is not None
+
+    def on_timeout(self, key):
+        if key not in self.outstanding:
+            return False
+        del self.outstanding[key]
+        self.retransmits.add(key)
+        # Only back off once per round trip, however many requests were lost at once
+        now = time.monotonic()
+        if (now - self.lastdecrease) >= self.rto:
+            self.lastdecrease = now
+            self.ssthresh = max(self.window / 2, self.minwindow)
+            self.window = self.ssthresh
+            self.rto = min(self.rto * 2, self.maxrto)
+        return True
+
+    def sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.minrto), self.maxrto)
@@ -1,8 +1,90 @@
+from array import array
+import bisect
+import hashlib
 import itertools
+from collections import namedtuple
+from multiprocessing import Pool
 from multiformats import multibase, multihash
-import random
-import psutil
 import utils
+from filepool import FilePool
+from chunkcache import ChunkCache
+
+
+# Nodes are keyed by their raw digest, the text form (RAFDP10zQm...) is only used on the wire and over RPC
+# second is None if the interior node only has one child
+Interior = namedtuple("Interior", ["first", "second"])
+# pointer to a chunk of a local file
+FileChunk = namedtuple("FileChunk", ["filename", "index", "size"])
+# downloaded leaf, the data itself is kept in the chunk cache
+CachedChunk = namedtuple("CachedChunk", ["size"])
+
+
+class FileTree:
+    # Digests of a local file's tree stored contiguously level by level (level 0 being the chunks),
+    # the children of node i are nodes 2i and 2i+1 of the level below.
+    # Lookups by digest use the first 8 bytes of every digest, sorted, next to the node they belong to.
+    def __init__(self, filename, chunk_size, levels, prefixes=None, nodeids=None):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.levels = levels
+        self.offsets = [0]
+        for level in levels:
+            self.offsets.append(self.offsets[-1] + len(level) // 32)
+        if prefixes is None:
+            prefixes, nodeids = self.build_index()
+        self.prefixes = prefixes
+        self.nodeids = nodeids
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __eq__(self, other):
+        return type(other) is FileTree and (self.filename, self.chunk_size, self.levels) == (other.filename, other.chunk_size, other.levels)
+
+    def build_index(self):
+        unsorted = array("Q", (int.from_bytes(level[offset:offset+8], "big") for level in self.levels for offset in range(0, len(level), 32)))
+        nodeids = array("I", sorted(range(len(unsorted)), key=unsorted.__getitem__))
+        prefixes = array("Q", (unsorted[nodeid] for nodeid in nodeids))
+        for i in range(1, len(prefixes)):
+            if prefixes[i] == prefixes[i-1] and self.digest(*self.locate(nodeids[i])) == self.digest(*self.locate(nodeids[i-1])):
+                raise Exception("Hash detected twice in tree?")
+        return prefixes, nodeids
+
+    def locate(self, nodeid):
+        level = bisect.bisect_right(self.offsets, nodeid) - 1
+        return level, nodeid - self.offsets[level]
+
+    def digest(self, level, position):
+        return bytes(self.levels[level][position*32:(position+1)*32])
+
+    def root(self):
+        return self.digest(len(self.levels) - 1, 0)
+
+    def find(self, key):
+        prefix = int.from_bytes(key[:8], "big")
+        i = bisect.bisect_left(self.prefixes, prefix)
+        while i < len(self.prefixes) and self.prefixes[i] == prefix:
+            position = self.locate(self.nodeids[i])
+            if self.digest(*position) == key:
+                return position
+            i += 1
+        return None
+
+    def value(self, level, position):
+        if level == 0:
+            return FileChunk(self.filename, position, self.chunk_size)
+        second = None
+        if (position * 2 + 1) * 32 < len(self.levels[level-1]):
+            second = self.digest(level - 1, position * 2 + 1)
+        return Interior(self.digest(level - 1, position * 2), second)
+
+
+def hash_chunk(indexedchunk):
+    index, chunk = indexedchunk
+    return MerkleTree.digest(utils.tovarint(index) + chunk)
+
+def hash_node(node):
+    return MerkleTree.digest(MerkleTree.format_node(node).encode("ascii"))
 
 
 class MerkleTree:
@@ -11,123 +93,227 @@ class MerkleTree:
     chunk_size = 16384  # 16 KiB
     hash_algorithm = "sha2-256"
     base_encoding = "base58btc"
+    hash_prefix = multihash.wrap(bytes(32), hash_algorithm)[:2]
+    text_prefix = magic_header + version_number.decode("ascii") + multibase.get(base_encoding).code
 
     @classmethod
-    def generate_hash(cls, data):
+    def digest(cls, data):
+        return hashlib.sha256(data).digest()
+
+    @classmethod
+    def encode_hash(cls, digest):
         # magic header + version number + multibase + multihash
-        hashed = multihash.digest(data, cls.hash_algorithm)
-        encoded = multibase.encode(hashed, cls.base_encoding)
-        result = cls.magic_header + cls.version_number.decode("ascii") + encoded
-        return result
+        return cls.text_prefix + utils.tobase58(cls.hash_prefix + digest)
+
+    @classmethod
+    def decode_hash(cls, text):
+        if not text.startswith(cls.text_prefix):
+            raise ValueError(f"{text!r} is not a RAFDP hash")
+        hashed = utils.frombase58(text[len(cls.text_prefix):])
+        if len(hashed) != len(cls.hash_prefix) + 32 or not hashed.startswith(cls.hash_prefix):
+            raise ValueError(f"{text!r} is not a RAFDP hash")
+        return hashed[len(cls.hash_prefix):]
+
+    @classmethod
+    def generate_hash(cls, data):
+        return cls.encode_hash(cls.digest(data))
+
+    @classmethod
+    def format_node(cls, node):
+        if node.second is None:
+            return cls.encode_hash(node.first)
+        return cls.encode_hash(node.first) + "," + cls.encode_hash(node.second)
+
+    @classmethod
+    def parse_node(cls, text):
+        hashes = text.split(",")
+        if len(hashes) == 1:
+            return Interior(cls.decode_hash(hashes[0]), None)
+        if len(hashes) == 2:
+            return Interior(cls.decode_hash(hashes[0]), cls.decode_hash(hashes[1]))
+        raise ValueError(f"{text!r} is not a node")
 
-    def __init__(self):
+    def __init__(self, store=None):
         self.tree = {}
         self.roothashes = {}
+        # keys whose value hasn't been received yet
+        self.missing = set()
+        # trees of locally added files, kept out of the dict above
+        self.filetrees = []
+        self.filepool = FilePool()
+        # downloaded leaves, written to the blob store (if given) as they are received
+        self.chunks = ChunkCache(store=store)
+        # leaves restored from the store whose hash hasn't been checked yet
+        self.unverified = set()
+        # called with the hash of a restored leaf that turned out to be corrupt (so it can be downloaded again)
+        self.onmissing = None
+
+    def __len__(self):
+        return len(self.tree) + sum(map(len, self.filetrees))
 
-    def generate_tree(self, filename):
-        chunkhashes = []
-        tree = {}
+    def generate_tree(self, filename, workers=1):
+        roothash, tree = self.hash_file(filename, workers=workers)
+        self.update(tree)
+        self.addroothash(roothash)
+        return roothash
+
+    def hash_file(self, filename, workers=1):
+        # workers > 1 hashes chunks (and each level of the tree) in a process pool,
+        # the resulting tree is identical to the one generated serially
+        if workers > 1:
+            with Pool(workers) as pool:
+                return self._hash_file(filename, workers, lambda function, items: pool.map(function, items, chunksize=64))
+        return self._hash_file(filename, workers, lambda function, items: list(map(function, items)))
+
+    def _hash_file(self, filename, workers, hashmap):
+        batchsize = workers * 256
+        leaves = bytearray()
 
         with open(filename, "rb") as file:
             while True:
-                chunk = file.read(self.chunk_size)
-                if not chunk:
+                # only read a batch of chunks at a time so large files aren't loaded into memory
+                batch = []
+                while len(batch) < batchsize:
+                    chunk = file.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    batch.append((len(leaves) // 32 + len(batch), chunk))
+                if not batch:
                     break
-                chunk = utils.tovarint(len(chunkhashes)) + chunk
-                chunkhash = self.generate_hash(chunk)
-                # pointer to offset in file stored in tree
-                tree[chunkhash] = (filename, len(chunkhashes), self.chunk_size)
-                chunkhashes.append(chunkhash)
+                for chunkhash in hashmap(hash_chunk, batch):
+                    leaves += chunkhash
+        if not leaves:
+            raise Exception(f"{filename} is empty")
 
         # generate merkle tree and determine root hash
-        while len(chunkhashes) > 1:
-            newchunkhashes = []
-            for pair in itertools.zip_longest(*[iter(chunkhashes)] * 2):
-                first, second = pair
-                if second is None:
-                    pair = first
-                else:
-                    pair = first + "," + second
-                chunkhash = self.generate_hash(pair.encode("ASCII"))
-                if chunkhash in tree:
-                    raise Exception("Hash detected twice in tree?")
-                tree[chunkhash] = pair
-                newchunkhashes.append(chunkhash)
-            chunkhashes = newchunkhashes
-
-        self.tree.update(tree)
-
-        roothash = chunkhashes[0]
-        self.addroothash(roothash)
+        levels = [leaves]
+        while len(levels[-1]) > 32:
+            below = levels[-1]
+            level = bytearray()
+            for start in range(0, len(below), batchsize * 64):
+                digests = [bytes(below[offset:offset+32]) for offset in range(start, min(start + batchsize * 64, len(below)), 32)]
+                nodes = [Interior(first, second) for first, second in itertools.zip_longest(*[iter(digests)] * 2)]
+                for chunkhash in hashmap(hash_node, nodes):
+                    level += chunkhash
+            levels.append(level)
 
-        return roothash
+        filetree = FileTree(filename, self.chunk_size, levels)
+        return self.encode_hash(filetree.root()), filetree
+
+    def update(self, tree):
+        if type(tree) is FileTree:
+            self.filetrees.append(tree)
+            # hashes that were wanted but are part of the file don't need to be downloaded any more
+            for key in [key for key in self.missing if tree.find(key) is not None]:
+                del self.tree[key]
+                self.missing.discard(key)
+        else:
+            self.tree.update(tree)
+            self.missing.difference_update(tree)
+
+    def _find(self, key):
+        for filetree in self.filetrees:
+            position = filetree.find(key)
+            if position is not None:
+                return filetree, position
+        return None
 
     def addroothash(self, roothash, filesize=75856):
         self.roothashes[roothash] = filesize
 
+    def _key(self, key):
+        # keys can be given as text or as a raw digest
+        if type(key) is str:
+            return self.decode_hash(key)
+        return key
+
     def set(self, key, value=None, setmissing=True):
-        if setmissing:
-            if type(value) is str:
-                if "," in value:
-                    # pair of hashes
-                    first, second = value.split(",")
-                    self.tree[first] = None
-                    self.tree[second] = None
-                else:
-                    # single hash
-                    self.tree[value] = None
-            elif type(value) is tuple or type(value) is bytes or value is None:
-                pass
-            else:
-                raise Exception(value)
+        key = self._key(key)
+        if type(value) is str:
+            value = self.parse_node(value)
+        elif type(value) is tuple:
+            value = FileChunk(*value)
+        elif type(value) is bytes:
+            self.chunks.add(key, value)
+            value = CachedChunk(len(value))
+        elif type(value) not in (Interior, FileChunk, CachedChunk) and value is not None:
+            raise Exception(value)
+        if setmissing and type(value) is Interior:
+            for child in value:
+                if child is not None:
+                    self.tree[child] = None
+                    self.missing.add(child)
         self.tree[key] = value
+        if value is None:
+            self.missing.add(key)
+        else:
+            self.missing.discard(key)
+
+    def restore_leaf(self, key):
+        # A leaf already in the chunk cache's store from an earlier run, its hash is checked when it is first read
+        key = self._key(key)
+        self.tree[key] = CachedChunk(None)
+        self.unverified.add(key)
+        self.missing.discard(key)
 
     def key_in_tree(self, key):
-        return key in self.tree
+        try:
+            key = self._key(key)
+        except ValueError:
+            return False
+        return key in self.tree or self._find(key) is not None
 
     def get(self, key, expandtuple=False):
-        value = self.tree[key]
-        typeid = None
-        if type(value) is str:
-            if value.startswith("RAFDP"):
-                if ",RAFDP" in value:
-                    # pair of hashes
-                    typeid = 1
-                else:
-                    # single hash
-                    typeid = 0
-        elif type(value) is tuple:
+        key = self._key(key)
+        if key in self.tree:
+            value = self.tree[key]
+        else:
+            found = self._find(key)
+            if found is None:
+                raise KeyError(key)
+            filetree, position = found
+            value = filetree.value(*position)
+        if type(value) is Interior:
+            # single hash or pair of hashes
+            typeid = 0 if value.second is None else 1
+            value = self.format_node(value)
+        elif type(value) is FileChunk:
             if expandtuple:
                 # binary chunk data
                 typeid = 3
-                with open(value[0], "rb") as file:
-                    file.seek(value[1]*value[2])
-                    filepart = file.read(value[2])
-                filepart = utils.tovarint(value[1]) + filepart
-                value = filepart
+                with self.filepool.read(value.filename, value.index*value.size, value.size) as filepart:
+                    value = utils.tovarint(value.index) + filepart
             else:
                 typeid = 2
+                value = tuple(value)
         elif value is None:
             typeid = 5
-        elif type(value) is bytes:
+        elif type(value) is CachedChunk:
             # binary chunk data
             typeid = 3
+            value = self.chunks.get(key)
+            if key in self.unverified:
+                self.unverified.discard(key)
+                if value is None or self.digest(value) != key:
+                    self.chunks.discard(key)
+                    self.set(key, None, setmissing=False)
+                    if self.onmissing is not None:
+                        self.onmissing(self.encode_hash(key))
+                    return 5, None
+            if value is None:
+                raise Exception(f"{self.encode_hash(key)} isn't in the chunk cache")
         else:
             raise Exception(value)
-
-        if typeid is None:
-            raise Exception(value)
         return typeid, value
 
     def get_missing(self):
-        return [key for key in self.tree if self.tree[key] is None]
+        return [self.encode_hash(key) for key in self.missing]
+
+    def is_missing(self, key):
+        try:
+            return self._key(key) in self.missing
+        except ValueError:
+            return False
 
     def is_complete(self):
-        return len(self.get_missing()) == 0
-
-    def reduce_tree_size(self):
-        # When running out of RAM
-        if psutil.virtual_memory().percent >= 95:
-            choices = list(set(self.tree.keys()) - set(self.roothashes))
-            if len(choices) > 0:
-                del self.tree[random.choice(choices)]
+        return len(self.missing) == 0
@@ -0,0 +1,53 @@
+import mmap
+import threading
+from collections import OrderedDict
+
+
+class FilePool:
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.maps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, filename, offset, size):
+        # Returns a zero-copy view of part of the file, the least recently used
+        # files are unmapped once more than maxsize files are open
+        with self.lock:
+            if filename in self.maps and len(self.maps[filename]) < offset + size:
+                # the file has grown since it was mapped
+                self._close(self.maps.pop(filename))
+            if filename in self.maps:
+                self.hits += 1
+                self.maps.move_to_end(filename)
+                mapped = self.maps[filename]
+            else:
+                self.misses += 1
+                with open(filename, "rb") as file:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[filename] = mapped
+                while len(self.maps) > self.maxsize:
+                    _, evicted = self.maps.popitem(last=False)
+                    self._close(evicted)
+            return memoryview(mapped)[offset:offset + size]
+
+    def close(self, filename=None):
+        with self.lock:
+            if filename is None:
+                filenames = list(self.maps)
+            else:
+                filenames = [filename] if filename in self.maps else []
+            for filename in filenames:
+                self._close(self.maps.pop(filename))
+
+    def _close(self, mapped):
+        try:
+            mapped.close()
+        except BufferError:
+            # Views of it are still in use, it'll be unmapped once they are released
+            pass
+
+    def stats(self):
+        with self.lock:
+            return {"open": len(self.maps), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,55 @@
+import time
+
+
+class PeerStats:
+    # Rolling (exponentially weighted) round trip time, throughput and loss rate of a peer
+    alpha = 0.125
+    throughputinterval = 1
+
+    def __init__(self):
+        self.rtt = None
+        self.loss = 0
+        self.throughput = 0
+        self.delivered = 0
+        self.intervalstart = time.monotonic()
+        self.lastheard = None
+        self.created = time.time()
+
+    def heard(self):
+        self.lastheard = time.time()
+
+    def add_rtt(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.alpha * (rtt - self.rtt)
+
+    def add_delivered(self, numbytes):
+        self.delivered += numbytes
+        self.update_throughput()
+
+    def update_throughput(self):
+        elapsed = time.monotonic() - self.intervalstart
+        if elapsed >= self.throughputinterval:
+            self.throughput += 2 * self.alpha * ((self.delivered / elapsed) - self.throughput)
+            self.delivered = 0
+            self.intervalstart = time.monotonic()
+
+    def add_outcome(self, lost):
+        self.loss += self.alpha * (int(lost) - self.loss)
+
+    def idle(self):
+        # Seconds since anything was heard from the peer (or since it was added)
+        if self.lastheard is None:
+            return time.time() - self.created
+        return time.time() - self.lastheard
+
+    def score(self):
+        # Higher is better, fast peers first and unreliable ones last
+        self.update_throughput()
+        rtt = self.rtt if self.rtt is not None else 1
+        return (self.throughput + 1 / max(rtt, 0.001)) * (1 - self.loss)
+
+    def as_dict(self):
+        self.update_throughput()
+        return {"rtt": self.rtt, "throughput": self.throughput, "loss": self.loss, "lastheard": self.lastheard}
@@ -7,7 +7,7 @@ rafdpprocess = None
 
 def addfile(args):
     filename = args.filename
-    print(rafdpprocess.addfile(filename))
+    print(rafdpprocess.addfile(filename, workers=args.workers))
 
 def getport(args):
     print(rafdpprocess.getport())
@@ -38,8 +38,18 @@ def addurl(args):
     print(rafdpprocess.addurl(url))
 
 def getpeers(args):
-    for peer in rafdpprocess.getpeers():
-        print(*peer)
+    for peer in rafdpprocess.getpeerstats():
+        rtt = "unknown" if peer["rtt"] is None else f"{peer['rtt'] * 1000:.1f}ms"
+        print(peer["ip"], peer["port"], "valid" if peer["valid"] else "invalid", f"rtt={rtt}",
+              f"throughput={peer['throughput'] / 1024:.1f}KiB/s", f"loss={peer['loss'] * 100:.1f}%", f"window={peer['window']}")
+
+def getfilepoolstats(args):
+    for key, value in rafdpprocess.getfilepoolstats().items():
+        print(key, value)
+
+def getcachestats(args):
+    for key, value in rafdpprocess.getcachestats().items():
+        print(key, value)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -49,6 +59,7 @@ if __name__ == "__main__":
 
     addfileparser = subparsers.add_parser("addfile", help="Add a file to be shared")
     addfileparser.add_argument("filename", type=str)
+    addfileparser.add_argument("--workers", type=int, default=None, help="Number of processes used to hash the file (defaults to the server's --workers)")
     addfileparser.set_defaults(func=addfile)
 
     getportparser = subparsers.add_parser("getport", help="Gets the port number of the server")
@@ -70,13 +81,19 @@ if __name__ == "__main__":
     gethashparser.add_argument("hash", type=str)
     gethashparser.set_defaults(func=gethash)
 
-    addurlparser = subparsers.add_parser("addtrackerurl", help="Add BitTorrent tracker url for peer discovery")
+    addurlparser = subparsers.add_parser("addtrackerurl", help="Add BitTorrent tracker url (http:// or udp://) for peer discovery")
     addurlparser.add_argument("url", type=str)
     addurlparser.set_defaults(func=addurl)
 
-    getpeersparser = subparsers.add_parser("getpeers", help="Get list of peers currently added")
+    getpeersparser = subparsers.add_parser("getpeers", help="Get list of peers currently added (and their statistics)")
     getpeersparser.set_defaults(func=getpeers)
 
+    getfilepoolstatsparser = subparsers.add_parser("getfilepoolstats", help="Get hit/miss counts of the pool of open shared files")
+    getfilepoolstatsparser.set_defaults(func=getfilepoolstats)
+
+    getcachestatsparser = subparsers.add_parser("getcachestats", help="Get memory and disk use of the cache of downloaded chunks")
+    getcachestatsparser.set_defaults(func=getcachestats)
+
     args = parser.parse_args()
     rpcport = args.rpcport
     rafdpprocess = RAFDPProcess(rpcport, openprocess=False)
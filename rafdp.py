@@ -1,4 +1,6 @@
 import socketserver
+from socket import IPPROTO_TCP, TCP_NODELAY
+import asyncio
 import threading
 import time
 import json
@@ -9,18 +11,59 @@ import tempfile
 import base64
 import platform
 import subprocess
+import ipaddress
+from collections import OrderedDict, deque
 from pathlib import Path
 
 import utils
-from core import MerkleTree
+from core import MerkleTree, Interior
 from trackerclient import TrackerClient
+from treeindex import TreeIndex, filestat
+from blobstore import BlobStore
+from scheduler import Scheduler
+from congestion import CongestionWindow
+from reassembly import ReassemblyBuffer
+from selection import PieceSelector
+from peerstats import PeerStats
 
 files = {}
 overalltree = MerkleTree()
 peers = {}
-reassemble = {}
-tctimeout = time.time()
+# leaves are the chunk plus the varint of its index (at most 16 bytes)
+reassemble = ReassemblyBuffer(MerkleTree.chunk_size + 16)
+scheduler = Scheduler()
+selector = PieceSelector()
 stopnow = False
+workers = 1
+treeindex = None
+# (root hash, chunk index) -> leaf hash, so reading a chunk again doesn't walk down the tree
+chunkcache = OrderedDict()
+chunkcachesize = 65536
+chunkcachelock = threading.Lock()
+# root hash -> (chunk size, number of chunks, file size)
+hashstats = {}
+# interior nodes received since the download state was last saved to the index
+checkpointnodes = deque()
+checkpointinterval = 2
+# notified whenever a hash is received (or a file added) so blocked readers can check again
+arrivals = threading.Condition()
+# number of chunks after the one being waited for that are kept requested while streaming a range
+readrangewindow = 64
+# Fragment sizes used when sending leaves to peers over the internet and to peers on the same machine/LAN,
+# peers which haven't told us what they can receive (e.g. older versions) are sent 508 byte fragments
+fragmentsize = 1200
+lanfragmentsize = 8192
+capabilities = {"maxfragmentsize": 65000, "nack": True, "batch": 32, "pex": True}
+# Peers are pinged after keepalive seconds of silence and forgotten after deadpeertimeout seconds,
+# peers losing more than unreliableloss of requests are only sent one request at a time
+keepalive = 60
+deadpeertimeout = 600
+unreliableloss = 0.5
+# Peer exchange: how often each peer is sent the peers recently heard from, at most how many are in one message
+# and how many peers can be known before no more are taken from peer exchange
+pexinterval = 5
+pexmaxpeers = 50
+pexpeerlimit = 200
 
 def fix_udp_macos():
     if platform.system() == "Darwin":
@@ -29,117 +72,660 @@ def fix_udp_macos():
         if maxdatagram != 65535:
             os.system("""osascript -e 'do shell script "sudo sysctl -w net.inet.udp.maxdgram=65535" with administrator privileges'""")
 
-def add_file(filename):
+def add_file(filename, workers=1):
     global overalltree
-    if filename not in files:
-        files[filename] = overalltree.generate_tree(filename)
-    return files[filename]
+    path = os.path.abspath(filename)
+    if path not in files:
+        roothash = None
+        if treeindex is not None:
+            roothash = treeindex.lookup(path)
+        if roothash is not None:
+            overalltree.update(treeindex.load(path, MerkleTree.chunk_size))
+        else:
+            stat = filestat(path)
+            roothash, tree = overalltree.hash_file(path, workers=workers)
+            overalltree.update(tree)
+            if treeindex is not None:
+                treeindex.add(path, roothash, tree, stat)
+        overalltree.addroothash(roothash)
+        files[path] = roothash
+        notify_arrivals()
+    return files[path]
+
+def load_index():
+    # Files that haven't changed since they were indexed are loaded first without rehashing
+    changed = []
+    for path in treeindex.files():
+        if treeindex.lookup(path) is not None:
+            add_file(path)
+        elif os.path.isfile(path):
+            changed.append(path)
+        else:
+            treeindex.remove(path)
+    for path in changed:
+        add_file(path, workers)
+    load_downloads()
+
+def load_downloads():
+    # Downloads in progress when the daemon was stopped carry on, only what is still missing is requested
+    nodes = treeindex.download_nodes()
+    store = overalltree.chunks.store
+    for roothash in treeindex.downloads():
+        missing = []
+        stack = [MerkleTree.decode_hash(roothash)]
+        while stack:
+            key = stack.pop()
+            if overalltree.key_in_tree(key) and not overalltree.is_missing(key):
+                continue
+            if key in nodes:
+                overalltree.set(key, nodes[key], setmissing=False)
+                stack.extend(child for child in nodes[key] if child is not None)
+            elif store is not None and key in store:
+                overalltree.restore_leaf(key)
+            else:
+                overalltree.set(key, None, setmissing=False)
+                missing.append(key)
+        overalltree.addroothash(roothash)
+        logging.info(f"Resuming download of {roothash}, {len(missing)} hashes left to request")
+        for key in missing:
+            request_hash(MerkleTree.encode_hash(key))
+        notify_arrivals()
+
+def checkpoint():
+    # Interior nodes received since the last checkpoint are saved so the download can carry on after a restart
+    nodes = []
+    while checkpointnodes:
+        key = checkpointnodes.popleft()
+        node = overalltree.tree.get(key)
+        if type(node) is Interior:
+            nodes.append((key, node))
+    if nodes:
+        treeindex.add_nodes(nodes)
 
 def add_hash(rafdphash):
     global overalltree
     if not overalltree.key_in_tree(rafdphash):
         overalltree.set(rafdphash, setmissing=False)
+        request_hash(rafdphash)
     overalltree.addroothash(rafdphash)
+    if treeindex is not None:
+        treeindex.add_download(rafdphash)
 
-def background(socket):
-    global tctimeout
-    global stopnow
+def lookup_hash(thehash):
+    # The value of thehash if it has been received, otherwise it is requested from peers
+    if overalltree.key_in_tree(thehash):
+        return overalltree.get(thehash, expandtuple=True)[1]
+    overalltree.set(thehash, None, setmissing=False)
+    request_hash(thehash)
+    return None
+
+def get_chunk(roothash, index, highestindex):
+    # Leaf data for chunk index of roothash or None if a node on the way down hasn't been received yet
+    key = (roothash, index)
+    with chunkcachelock:
+        thehash = chunkcache.get(key)
+        if thehash is not None:
+            chunkcache.move_to_end(key)
+    if thehash is None:
+        thehash = roothash
+        if highestindex != 0:
+            for direction in bin(index)[2:].zfill(len(bin(highestindex)[2:])):
+                value = lookup_hash(thehash)
+                if value is None:
+                    return None
+                thehash = value.split(",")[int(direction)]
+        with chunkcachelock:
+            chunkcache[key] = thehash
+            if len(chunkcache) > chunkcachesize:
+                chunkcache.popitem(last=False)
+    return lookup_hash(thehash)
+
+def hash_stats(roothash):
+    # (chunk size, number of chunks, file size) of roothash from its first and last leaves, None if they haven't been received yet
+    if roothash not in hashstats:
+        leaves = []
+        for last in (False, True):
+            value = lookup_hash(roothash)
+            while type(value) is str:
+                value = lookup_hash(value.split(",")[-1 if last else 0])
+            if value is None:
+                return None
+            leaves.append(utils.fromvarint(value))
+        (_, firstchunk), (lastindex, lastchunk) = leaves
+        hashstats[roothash] = (len(firstchunk), lastindex + 1, len(firstchunk) * lastindex + len(lastchunk))
+    return hashstats[roothash]
+
+def read_range(roothash, offset, size, timeout=None):
+    # Yields the data of roothash from offset a chunk at a time, stopping early if a chunk doesn't arrive within timeout
+    chunksize, numchunks, filesize = hash_stats(roothash)
+    if size <= 0:
+        return
+    firstindex, lastindex = offset // chunksize, (offset + size - 1) // chunksize
+    for index in range(firstindex, lastindex + 1):
+        def fetch():
+            chunk = get_chunk(roothash, index, numchunks - 1)
+            if chunk is None:
+                # keep the following chunks requested so they download while this one is waited for
+                for ahead in range(index + 1, min(index + readrangewindow, lastindex + 1)):
+                    get_chunk(roothash, ahead, numchunks - 1)
+            return chunk
+        chunk = wait_for(fetch, timeout)
+        if chunk is None:
+            return
+        _, data = utils.fromvarint(chunk)
+        yield data[max(offset - index * chunksize, 0):offset + size - index * chunksize]
+
+def new_peer(valid=False):
+    return {"valid": valid, "lastcontact": 0, "window": CongestionWindow(), "capabilities": {}, "stats": PeerStats(), "pingsent": None,
+            "pexsent": 0, "pexreceived": None}
+
+def fragment_size(peer):
+    peercapabilities = peers[peer]["capabilities"] if peer in peers else {}
+    if "maxfragmentsize" not in peercapabilities:
+        return 508
+    address = ipaddress.ip_address(peer[0])
+    if address.is_loopback or address.is_private:
+        size = lanfragmentsize
+    else:
+        size = fragmentsize
+    return min(size, peercapabilities["maxfragmentsize"])
+
+def send_capabilities(socket, peer):
+    # Older peers ignore this (and so are treated as having no optional capabilities)
+    socket.sendto(b"RAFDPCAPS" + json.dumps(capabilities).encode("ascii"), peer)
+
+def send_leaf(socket, peer, wantedhash, leaf, chunksize, indices=None):
+    # The leaf is split into chunks so it will fit within a UDP packet,
+    # indices can be given to only (re)send some of them
+    offsets = list(range(0, len(leaf), chunksize))
+    if indices is None:
+        indices = range(len(offsets))
+    for index in indices:
+        if index >= len(offsets):
+            continue
+        i = offsets[index]
+        tosendhashpart = (1).to_bytes(1, "big") + (1).to_bytes(1, "big")
+        tosendhashpart += utils.tovarint(index) + utils.tovarint(len(offsets))
+        tosendhashpart += utils.tovarint(len(wantedhash.encode("ascii")))
+        tosendhashpart += wantedhash.encode("ascii") + leaf[i:i + chunksize]
+        socket.sendto(tosendhashpart, peer)
+
+def send_pex(socket, peer):
+    # The peers most recently heard from (apart from peer itself) for one of our roots, a different one each time
+    roots = sorted(overalltree.roothashes)
+    recent = sorted((other for other in valid_peers() if other != peer), key=lambda other: peers[other]["stats"].idle())
+    if not roots or not recent:
+        return
+    values = peers[peer]
+    root = roots[values["pexsent"] % len(roots)]
+    values["pexsent"] += 1
+    message = (5).to_bytes(1, "big") + utils.tovarint(len(root)) + root.encode("ascii")
+    socket.sendto(message + utils.encode_peers(recent[:pexmaxpeers]), peer)
+
+def receive_pex(peer, gotdata):
+    # Only taken from peers that have answered a ping (so the source isn't spoofed) and no more often than they should send it
+    if peer not in peers or not peers[peer]["valid"]:
+        return
+    now = time.monotonic()
+    if peers[peer]["pexreceived"] is not None and (now - peers[peer]["pexreceived"]) < pexinterval / 2:
+        return
+    peers[peer]["pexreceived"] = now
+    rootlength, gotdata = utils.fromvarint(gotdata)
+    root, gotdata = gotdata[0:rootlength].decode("ascii"), gotdata[rootlength:]
+    if not overalltree.key_in_tree(root):
+        return
+    for newpeer in utils.decode_peers(gotdata[:min(len(gotdata) // 6, pexmaxpeers) * 6]):
+        if len(peers) >= pexpeerlimit:
+            break
+        add_peer(newpeer)
+
+def missing_fragments_request(peer, missinghash):
+    # A request for only the fragments of a partially received leaf that haven't arrived (if the peer supports it)
+    if not peers[peer]["capabilities"].get("nack"):
+        return None
+    missing = reassemble.missing((peer, missinghash))
+    if missing is None:
+        return None
+    chunksize, bitmap = missing
+    request = (2).to_bytes(1, "big") + utils.tovarint(chunksize)
+    request += utils.tovarint(len(missinghash.encode("ascii"))) + missinghash.encode("ascii")
+    return request + bitmap
+
+def send_hash(socket, peer, wantedhash, batch=None):
+    # Interior nodes are added to batch (if given) to be sent together instead of in their own datagram
+    if overalltree.key_in_tree(wantedhash):
+        typeid, tosendhash = overalltree.get(wantedhash, expandtuple=True)
+        if typeid != 3:
+            # Non-binary data e.g. another hash (or pair of hashes)
+            tosendhash = tosendhash.encode("ascii")
+            if batch is not None:
+                batch.append(tosendhash)
+            else:
+                socket.sendto((1).to_bytes(1, "big") + (0).to_bytes(1, "big") + tosendhash, peer)
+        else:
+            # Actual binary data (the "leaf" of the Merkle tree)
+            send_leaf(socket, peer, wantedhash, tosendhash, fragment_size(peer))
+
+def send_batch(socket, peer, nodes):
+    # Packs as many interior nodes into each datagram as will fit
+    maxsize = fragment_size(peer)
+    response = (4).to_bytes(1, "big")
+    for node in nodes:
+        encoded = utils.tovarint(len(node)) + node
+        if len(response) > 1 and (len(response) + len(encoded)) > maxsize:
+            socket.sendto(response, peer)
+            response = (4).to_bytes(1, "big")
+        response += encoded
+    if len(response) > 1:
+        socket.sendto(response, peer)
+
+def receive_node(peer, gotdata):
+    # Non-binary data e.g. another hash (or pair of hashes)
+    digest = MerkleTree.digest(gotdata)
+    gotdata = gotdata.decode("ascii")
+    if overalltree.is_missing(digest):
+        overalltree.set(digest, gotdata, setmissing=False)
+        checkpointnodes.append(digest)
+    # The peer that sent this node most likely has the hashes below it as well
+    selector.learn(peer, gotdata.split(","))
+    received_hash(peer, MerkleTree.encode_hash(digest))
+
+def add_peer(peer):
+    if peer not in peers:
+        peers[peer] = new_peer()
+        scheduler.schedule(("ping", peer))
+
+def validate_peer(peer):
+    if peer not in peers:
+        peers[peer] = new_peer()
+    wasvalid = peers[peer]["valid"]
+    peers[peer]["valid"] = True
+    peers[peer]["lastcontact"] = time.time()
+    if not wasvalid:
+        scheduler.schedule(("send", peer))
+
+def remove_peer(peer):
+    values = peers.pop(peer, None)
+    if values is None:
+        return
+    scheduler.cancel(("ping", peer))
+    scheduler.cancel(("send", peer))
+    scheduler.cancel(("pex", peer))
+    for missinghash in list(values["window"].outstanding):
+        scheduler.cancel(("timeout", peer, missinghash))
+    selector.release_peer(peer)
+    wake_senders()
+
+def valid_peers():
+    return [peer for peer, values in list(peers.items()) if values["valid"]]
+
+def can_request(values):
+    window = values["window"]
+    if values["stats"].loss > unreliableloss and window.outstanding:
+        return False
+    return window.can_send()
+
+def send_ping(socket, peer):
+    peers[peer]["lastcontact"] = time.time()
+    peers[peer]["pingsent"] = time.monotonic()
+    socket.sendto(b"RAFDPPING", peer)
+    send_capabilities(socket, peer)
+
+def wake_senders():
+    # Fastest peers first so they get the first pick of the missing hashes
+    for peer in sorted(valid_peers(), key=lambda peer: peers[peer]["stats"].score(), reverse=True):
+        if not scheduler.is_scheduled(("send", peer)):
+            scheduler.schedule(("send", peer))
+
+def request_hash(missinghash):
+    # The hash is assigned to a peer once one of them has room in its window
+    selector.add(missinghash)
+    wake_senders()
 
-    def addannouncedpeers(infohash):
-        gotpeers = tc.announce(infohash, 0, 0, overalltree.roothashes[infohash])
+def received_hash(peer, receivedhash):
+    # Acknowledges the request to the peer that answered and frees up the other peers' windows
+    selector.received(receivedhash)
+    for otherpeer, values in list(peers.items()):
+        if otherpeer == peer:
+            acknowledged = values["window"].on_ack(receivedhash)
+            if acknowledged:
+                values["stats"].add_outcome(False)
+                if values["window"].lastsample is not None:
+                    values["stats"].add_rtt(values["window"].lastsample)
+        else:
+            acknowledged = values["window"].release(receivedhash)
+        if acknowledged:
+            scheduler.cancel(("timeout", otherpeer, receivedhash))
+            scheduler.schedule(("send", otherpeer))
+    notify_arrivals()
+
+def notify_arrivals():
+    with arrivals:
+        arrivals.notify_all()
+
+def wait_for(function, timeout=None):
+    # Calls function until it returns something other than None, waiting for hashes to arrive in between
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with arrivals:
+        while True:
+            result = function()
+            if result is not None:
+                return result
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+            arrivals.wait(remaining)
+
+def addannouncedpeers(torrents):
+    for gotpeers in tc.announce_many(torrents).values():
         for peer in gotpeers:
-            if peer not in peers:
-                peers[peer] = {"valid": False, "lastcontact": 0, "missing": {}}
+            add_peer(peer)
 
-    while not stopnow:
-        for peer in peers:
-            if not peers[peer]["valid"]:
-                if (time.time() - peers[peer]["lastcontact"]) > 30:
-                    peers[peer]["lastcontact"] = time.time()
-                    socket.sendto(b"RAFDPPING", peer)
+def start_announce_thread(torrents):
+    # One thread announces every root at once, trackers that aren't due yet are skipped by the tracker client
+    announce_thread = threading.Thread(target=addannouncedpeers, args=(torrents,))
+    announce_thread.daemon = True
+    announce_thread.start()
+
+def run_job(socket, job, announce=start_announce_thread):
+    if job[0] in ("ping", "send", "timeout", "pex") and job[1] not in peers:
+        # Peer has been removed since
+        return
+    if job[0] == "ping":
+        peer = job[1]
+        if not peers[peer]["valid"]:
+            send_ping(socket, peer)
+            scheduler.schedule(job, 30)
+    elif job[0] == "send":
+        # Send as many requests as the peer's congestion window allows (for the hashes the selector
+        # assigns to it), several at a time to peers that accept batched requests
+        peer = job[1]
+        values = peers[peer]
+        window = values["window"]
+        batchsize = values["capabilities"].get("batch", 1)
+        maxsize = fragment_size(peer)
+        numpeers = len(valid_peers())
+        while values["valid"] and can_request(values):
+            batch = []
+            size = 1
+            while can_request(values) and len(batch) < batchsize:
+                missinghash = selector.next(peer, numpeers)
+                if missinghash is None:
+                    break
+                if not overalltree.is_missing(missinghash):
+                    selector.received(missinghash)
+                    continue
+                encoded = utils.tovarint(len(missinghash)) + missinghash.encode("ascii")
+                if batch and (size + len(encoded)) > maxsize:
+                    selector.release(peer, missinghash)
+                    break
+                batch.append((missinghash, encoded))
+                size += len(encoded)
+                window.on_send(missinghash)
+                scheduler.schedule(("timeout", peer, missinghash), window.rto)
+            if len(batch) == 1:
+                socket.sendto((0).to_bytes(1, "big") + batch[0][0].encode("ascii"), peer)
+            elif len(batch) > 1:
+                socket.sendto((3).to_bytes(1, "big") + b"".join(encoded for _, encoded in batch), peer)
+            else:
+                break
+    elif job[0] == "timeout":
+        _, peer, missinghash = job
+        window = peers[peer]["window"]
+        if window.on_timeout(missinghash) and overalltree.is_missing(missinghash):
+            peers[peer]["stats"].add_outcome(True)
+            request = missing_fragments_request(peer, missinghash)
+            if request is not None and window.can_send():
+                # Only the missing fragments of a partially received leaf are asked for again
+                socket.sendto(request, peer)
+                window.on_send(missinghash)
+                scheduler.schedule(("timeout", peer, missinghash), window.rto)
             else:
-                for missinghash in overalltree.get_missing():
-                    if missinghash not in peers[peer]["missing"]:
-                        peers[peer]["missing"][missinghash] = {"lastcontact": 0}
-                    if (time.time() - peers[peer]["missing"][missinghash]["lastcontact"]) > 5:
-                        peers[peer]["missing"][missinghash]["lastcontact"] = time.time()
-                        socket.sendto((0).to_bytes(1, "big") + missinghash.encode("ascii"), peer)
-        if (time.time() - tctimeout) > 10:
-            for infohash in overalltree.roothashes:
-                announce_thread = threading.Thread(target=addannouncedpeers, args=(infohash,))
-                announce_thread.start()
-            tctimeout = time.time()
-        time.sleep(0.0000001)
-
-class RAFDPHandler(socketserver.BaseRequestHandler):   
+                # Given to another peer if there is one (or retried later with this one)
+                selector.release(peer, missinghash, failed=True)
+                wake_senders()
+    elif job[0] == "pex":
+        peer = job[1]
+        if peers[peer]["valid"]:
+            send_pex(socket, peer)
+        scheduler.schedule(job, pexinterval)
+    elif job[0] == "maintenance":
+        for peer, values in list(peers.items()):
+            idle = values["stats"].idle()
+            if idle > deadpeertimeout:
+                logging.info(f"Removing {peer}, nothing heard from it for {int(idle)} seconds")
+                remove_peer(peer)
+            elif values["valid"] and idle > keepalive:
+                send_ping(socket, peer)
+        scheduler.schedule(job, 30)
+    elif job[0] == "checkpoint":
+        if treeindex is not None:
+            checkpoint()
+        scheduler.schedule(job, checkpointinterval)
+    elif job[0] == "announce":
+        torrents = [(infohash, 0, 0, left) for infohash, left in list(overalltree.roothashes.items())]
+        if torrents:
+            announce(torrents)
+        scheduler.schedule(job, 10)
+    else:
+        raise Exception(job)
+
+def background(socket):
+    # Sleeps until a ping, request, retransmit or announce is due instead of polling
+    scheduler.schedule(("announce",), 10)
+    scheduler.schedule(("maintenance",), 30)
+    scheduler.schedule(("checkpoint",), checkpointinterval)
+    while not stopnow:
+        for job in scheduler.wait():
+            run_job(socket, job)
+
+def handle_packet(data, socket, peer):
+    # socket can be anything with a sendto method (a socket or an asyncio transport)
+    isunknown = False
+
+    if data == b"RAFDPPING" or data == b"RAFDPPONG":
+        if data == b"RAFDPPING":
+            socket.sendto(b"RAFDPPONG", peer)
+            send_capabilities(socket, peer)
+        elif peer in peers and peers[peer]["pingsent"] is not None:
+            peers[peer]["stats"].add_rtt(time.monotonic() - peers[peer]["pingsent"])
+            peers[peer]["pingsent"] = None
+        validate_peer(peer)
+    elif data.startswith(b"RAFDPCAPS"):
+        if peer not in peers:
+            peers[peer] = new_peer()
+        peers[peer]["capabilities"] = json.loads(data[len(b"RAFDPCAPS"):].decode("ascii"))
+        if peers[peer]["capabilities"].get("pex") and not scheduler.is_scheduled(("pex", peer)):
+            scheduler.schedule(("pex", peer))
+    elif data[0] == 0:
+        # Request from other peer for data belonging to some hash
+        send_hash(socket, peer, data[1:].decode("ascii"))
+    elif data[0] == 1:
+        # Response from other peer containing result for requested hash
+        if peer in peers:
+            peers[peer]["stats"].add_delivered(len(data))
+        datatypefield = data[1]
+        gotdata = data[2:]
+        if datatypefield == 0:
+            receive_node(peer, gotdata)
+        elif datatypefield == 1:
+            # Binary data chunk (which needs to be reassembled once all chunks received)
+            index, gotdata = utils.fromvarint(gotdata)
+            numoffsets, gotdata = utils.fromvarint(gotdata)
+            hashlength, gotdata = utils.fromvarint(gotdata)
+            thehash, gotdata = gotdata[0:hashlength].decode("ascii"), gotdata[hashlength:]
+            # Each peer may use a different fragment size so fragments are reassembled per peer
+            reassembleddata = reassemble.add((peer, thehash), index, numoffsets, gotdata)
+            if reassembleddata is not None:
+                # All chunks received, the hash is checked straight from the reassembly buffer
+                digest = MerkleTree.digest(reassembleddata)
+                if overalltree.is_missing(digest):
+                    overalltree.set(digest, bytes(reassembleddata), setmissing=False)
+                received_hash(peer, MerkleTree.encode_hash(digest))
+    elif data[0] == 2:
+        # Request from other peer for only some fragments of a leaf (a bitmap of the ones it is missing)
+        chunksize, gotdata = utils.fromvarint(data[1:])
+        hashlength, gotdata = utils.fromvarint(gotdata)
+        wantedhash, bitmap = gotdata[0:hashlength].decode("ascii"), gotdata[hashlength:]
+        if overalltree.key_in_tree(wantedhash):
+            typeid, tosendhash = overalltree.get(wantedhash, expandtuple=True)
+            if typeid == 3 and chunksize > 0:
+                indices = [index for index in range(len(bitmap) * 8) if bitmap[index // 8] & (1 << (7 - index % 8))]
+                send_leaf(socket, peer, wantedhash, tosendhash, chunksize, indices)
+    elif data[0] == 3:
+        # Request from other peer for several hashes at once (at most as many as we said we accept)
+        gotdata = data[1:]
+        nodes = []
+        for _ in range(capabilities["batch"]):
+            if not gotdata:
+                break
+            hashlength, gotdata = utils.fromvarint(gotdata)
+            wantedhash, gotdata = gotdata[0:hashlength].decode("ascii"), gotdata[hashlength:]
+            send_hash(socket, peer, wantedhash, batch=nodes)
+        send_batch(socket, peer, nodes)
+    elif data[0] == 4:
+        # Response from other peer containing several interior nodes
+        if peer in peers:
+            peers[peer]["stats"].add_delivered(len(data))
+        gotdata = data[1:]
+        while gotdata:
+            nodelength, gotdata = utils.fromvarint(gotdata)
+            receive_node(peer, gotdata[0:nodelength])
+            gotdata = gotdata[nodelength:]
+    elif data[0] == 5:
+        # Peer exchange from other peer, peers it has recently heard from that share a root
+        receive_pex(peer, data[1:])
+    else:
+        isunknown = True
+
+    if peer in peers:
+        peers[peer]["stats"].heard()
+
+    if not isunknown:
+        logging.debug(f"{peer} wrote: {data}")
+    else:
+        logging.warning(f"{peer} wrote (is unknown): {data}")
+
+class RAFDPHandler(socketserver.BaseRequestHandler):
     def handle(self):
-        data = self.request[0]
-        socket = self.request[1]
-        peer = self.client_address
-        isunknown = False
-
-        if data == b"RAFDPPING" or data == b"RAFDPPONG":
-            if data == b"RAFDPPING":
-                socket.sendto(b"RAFDPPONG", peer)
-            if peer not in peers:
-                peers[peer] = {"missing": {}}
-            peers[peer]["valid"] = True
-            peers[peer]["lastcontact"] = time.time()
-        elif data[0] == 0:
-            # Request from other peer for data belonging to some hash
-            wantedhash = data[1:].decode("ascii")
-            if overalltree.key_in_tree(wantedhash):
-                typeid, tosendhash = overalltree.get(wantedhash, expandtuple=True)
-                if typeid != 3:
-                    # Non-binary data e.g. another hash (or pair of hashes)
-                    tosendhash = tosendhash.encode("ascii")
-                    socket.sendto((1).to_bytes(1, "big") + (0).to_bytes(1, "big") + tosendhash, peer)
-                else:
-                    # Actual binary data (the "leaf" of the Merkle tree)
-                    # We split it into chunks so it will fit within a UDP packet
-                    chunksize = 508
-                    offsets = list(range(0, len(tosendhash), chunksize))
-                    for index, i in enumerate(offsets):
-                        tosendhashpart = (1).to_bytes(1, "big") + (1).to_bytes(1, "big")
-                        tosendhashpart += utils.tovarint(index) + utils.tovarint(len(offsets))
-                        tosendhashpart += utils.tovarint(len(wantedhash.encode("ascii")))
-                        tosendhashpart += wantedhash.encode("ascii") + tosendhash[i:i + chunksize]
-                        socket.sendto(tosendhashpart, peer)
-        elif data[0] == 1:
-            # Response from other peer containing result for requested hash
-            datatypefield = data[1]
-            gotdata = data[2:]
-            if datatypefield == 0:
-                # Non-binary data e.g. another hash (or pair of hashes)
-                hasheddata = MerkleTree.generate_hash(gotdata)
-                gotdata = gotdata.decode("ascii")
-                if hasheddata in overalltree.get_missing():
-                    overalltree.set(hasheddata, gotdata, setmissing=False)
-                    overalltree.reduce_tree_size()
-            elif datatypefield == 1:
-                # Binary data chunk (which needs to be reassembled once all chunks received)
-                index, gotdata = utils.fromvarint(gotdata)
-                numoffsets, gotdata = utils.fromvarint(gotdata)
-                hashlength, gotdata = utils.fromvarint(gotdata)
-                thehash, gotdata = gotdata[0:hashlength].decode("ascii"), gotdata[hashlength:]
-                if thehash not in reassemble:
-                    reassemble[thehash] = {i:None for i in range(numoffsets)}
-                reassemble[thehash][index] = gotdata
-                if all(v is not None for v in reassemble[thehash].values()):
-                    # All chunks received
-                    reassembleddata = b"".join(reassemble[thehash][key] for key in sorted(reassemble[thehash]))
-                    del reassemble[thehash]
-                    hasheddata = MerkleTree.generate_hash(reassembleddata)
-                    if hasheddata in overalltree.get_missing():
-                        overalltree.set(hasheddata, reassembleddata, setmissing=False)
-                        overalltree.reduce_tree_size()
-        else:
-            isunknown = True
+        handle_packet(self.request[0], self.request[1], self.client_address)
+
+class RAFDPServer(socketserver.UDPServer):
+    # Large enough for any UDP datagram, so bigger fragments can be received
+    max_packet_size = 65535
+
+def encode_value(resp, value):
+    # leaves are binary so they are base64 encoded
+    if type(value) in (bytes, memoryview):
+        resp["hashed"] = base64.b64encode(value).decode("ascii")
+        resp["encoded"] = True
+    else:
+        resp["hashed"] = value
+        resp["encoded"] = False
 
-        if not isunknown:
-            logging.debug(f"{peer} wrote: {data}")
+def handle_rpc(data):
+    resp = {"success": True}
+    if data["method"] == "addfile":
+        resp["hash"] = add_file(data["filename"], data.get("workers") or workers)
+    elif data["method"] == "getport":
+        resp["port"] = port
+    elif data["method"] == "getpid":
+        resp["pid"] = os.getpid()
+    elif data["method"] == "addpeer":
+        add_peer((data["ip"], data["port"]))
+    elif data["method"] == "addhash":
+        add_hash(data["hash"])
+    elif data["method"] == "gethash":
+        thehash = data["hash"]
+        if overalltree.key_in_tree(thehash):
+            encode_value(resp, overalltree.get(thehash, expandtuple=True)[1])
         else:
-            logging.warning(f"{peer} wrote (is unknown): {data}")
+            overalltree.set(thehash, None, setmissing=False)
+            request_hash(thehash)
+            resp["success"] = False
+    elif data["method"] == "waithash":
+        # replies as soon as the hash has been received instead of having to be polled
+        value = wait_for(lambda: lookup_hash(data["hash"]), data.get("timeout"))
+        if value is not None:
+            encode_value(resp, value)
+        else:
+            resp["success"] = False
+    elif data["method"] == "getchunk":
+        chunk = wait_for(lambda: get_chunk(data["hash"], data["index"], data["highestindex"]), data.get("timeout") or 0)
+        if chunk is not None:
+            resp["chunk"] = base64.b64encode(chunk).decode("ascii")
+        else:
+            resp["success"] = False
+    elif data["method"] == "addurl":
+        tc.add_url(data["url"])
+    elif data["method"] == "getpeers":
+        resp["peers"] = list(peers.keys())
+    elif data["method"] == "getpeerstats":
+        resp["peers"] = []
+        for peer, values in list(peers.items()):
+            stats = {"ip": peer[0], "port": peer[1], "valid": values["valid"], "window": int(values["window"].window)}
+            stats.update(values["stats"].as_dict())
+            resp["peers"].append(stats)
+    elif data["method"] == "getfilepoolstats":
+        resp["stats"] = overalltree.filepool.stats()
+    elif data["method"] == "getcachestats":
+        resp["stats"] = overalltree.chunks.stats()
+    else:
+        # reply so clients can tell this method isn't supported instead of waiting for a timeout
+        logging.warning(f"Unknown RPC method {data['method']!r}")
+        resp["success"] = False
+        resp["error"] = "unknown method"
+    return resp
+
+def handle_stream(data):
+    # Messages sent back for a readrange request: a JSON header, the raw data and then an end message
+    stats = wait_for(lambda: hash_stats(data["hash"]), data.get("timeout"))
+    if stats is None:
+        yield utils.RESPONSE, json.dumps({"success": False, "error": "timed out"}).encode("ascii")
+    else:
+        chunksize, numchunks, filesize = stats
+        offset = min(max(data["offset"], 0), filesize)
+        size = max(min(data["size"], filesize - offset), 0)
+        yield utils.RESPONSE, json.dumps({"success": True, "size": size}).encode("ascii")
+        for piece in read_range(data["hash"], offset, size, data.get("timeout")):
+            yield utils.DATA, piece
+    yield utils.END, b""
+
+def handle_request(data):
+    # Messages sent back for a request over a persistent connection
+    if data["method"] == "readrange":
+        yield from handle_stream(data)
+    else:
+        yield utils.RESPONSE, json.dumps(handle_rpc(data)).encode("ascii")
+
+class ConnectionHandler(socketserver.BaseRequestHandler):
+    # A persistent connection from a client, every request is answered on its own thread so
+    # slow ones (e.g. waiting for a range to download) don't hold up the rest
+    def handle(self):
+        self.request.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.sendlock = threading.Lock()
+        while True:
+            try:
+                requestid, messagetype, payload = utils.recvmessage(self.request)
+            except OSError:
+                return
+            data = json.loads(payload.decode("ascii"))
+            threading.Thread(target=self.respond, args=(requestid, data), daemon=True).start()
+
+    def respond(self, requestid, data):
+        try:
+            for messagetype, payload in handle_request(data):
+                with self.sendlock:
+                    utils.sendmessage(self.request, requestid, messagetype, payload)
+        except OSError:
+            # the client has gone away
+            pass
+
+class ConnectionServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
 
 class RPCHandler(socketserver.BaseRequestHandler):
     def handle(self):
@@ -149,64 +735,95 @@ class RPCHandler(socketserver.BaseRequestHandler):
             logging.warning(f"Ignored request from {self.client_address[0]}, are you running the RPC server publicly?!")
             return
 
-        data = json.loads(data.decode("ascii"))
-        resp = {"success": True}
-        if data["method"] == "addfile":
-            resp["hash"] = add_file(data["filename"])
-        elif data["method"] == "getport":
-            resp["port"] = port
-        elif data["method"] == "getpid":
-            resp["pid"] = os.getpid()
-        elif data["method"] == "addpeer":
-            peer = (data["ip"], data["port"])
-            if peer not in peers:
-                peers[peer] = {"valid": False, "lastcontact": 0, "missing": {}}
-        elif data["method"] == "addhash":
-            add_hash(data["hash"])
-        elif data["method"] == "gethash":
-            thehash = data["hash"]
-            if overalltree.key_in_tree(thehash):
-                typeid, tosendhash = overalltree.get(thehash, expandtuple=True)
-                if typeid != 3:
-                    resp["hashed"] = tosendhash
-                    resp["encoded"] = False
-                else:
-                    resp["hashed"] = base64.b64encode(tosendhash).decode("ascii")
-                    resp["encoded"] = True
-            else:
-                overalltree.set(thehash, None, setmissing=False)
-                resp["success"] = False
-        elif data["method"] == "addurl":
-            tc.add_url(data["url"])
-        elif data["method"] == "getpeers":
-            resp["peers"] = list(peers.keys())
+        resp = handle_rpc(json.loads(data.decode("ascii")))
+        socket.sendto(json.dumps(resp).encode("ascii"), self.client_address)
+
+class RAFDPProtocol(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        handle_packet(data, self.transport, addr)
+
+class RPCProtocol(asyncio.DatagramProtocol):
+    # Methods that can take a while (e.g. hashing a file) are run in an executor instead of the event loop
+    executormethods = {"addfile", "waithash", "getchunk"}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if addr[0] != "127.0.0.1":
+            logging.warning(f"Ignored request from {addr[0]}, are you running the RPC server publicly?!")
+            return
+
+        data = json.loads(data.strip().decode("ascii"))
+        if data["method"] in self.executormethods:
+            future = asyncio.get_running_loop().run_in_executor(None, handle_rpc, data)
+            future.add_done_callback(lambda future: self.respond(future.result(), addr))
         else:
-            raise Exception(data)
+            self.respond(handle_rpc(data), addr)
 
-        socket.sendto(json.dumps(resp).encode("ascii"), self.client_address)
+    def respond(self, resp, addr):
+        self.transport.sendto(json.dumps(resp).encode("ascii"), addr)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("rpcport", type=int, nargs="?", default=7284, help="RPC port")
-    parser.add_argument("rafdpport", type=int, nargs="?", default=0, help="RAFDP port")
-    args = parser.parse_args()
+async def handle_connection_async(reader, writer):
+    loop = asyncio.get_running_loop()
+    writer.get_extra_info("socket").setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
 
-    logname = Path(tempfile.gettempdir()) / "rafdp" / "logs" / (str(args.rpcport) + ".log")
-    logname.parent.mkdir(parents=True, exist_ok=True)
-    loglevel = logging.INFO
+    async def respond(requestid, data):
+        messages = handle_request(data)
+        # requests that can take a while (hashing a file, waiting for a range to download) are answered from an executor
+        inexecutor = data["method"] == "readrange" or data["method"] in RPCProtocol.executormethods
+        while True:
+            if inexecutor:
+                message = await loop.run_in_executor(None, next, messages, None)
+            else:
+                message = next(messages, None)
+            if message is None:
+                break
+            writer.write(utils.tomessage(requestid, *message))
+            await writer.drain()
 
-    logging.basicConfig(
-        filename=logname,
-        filemode="w",
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        level=loglevel,
-        datefmt='%Y-%m-%d %H:%M:%S')
+    tasks = set()
+    try:
+        while True:
+            length, requestid, messagetype = utils.messageheader.unpack(await reader.readexactly(utils.messageheader.size))
+            data = json.loads((await reader.readexactly(length)).decode("ascii"))
+            task = loop.create_task(respond(requestid, data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
 
-    logging.getLogger().addHandler(logging.StreamHandler())
+async def background_async(transport):
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    scheduler.onwake = lambda: loop.call_soon_threadsafe(wakeup.set)
 
-    fix_udp_macos()
+    async def announce(torrents):
+        await loop.run_in_executor(None, addannouncedpeers, torrents)
+
+    scheduler.schedule(("announce",), 10)
+    scheduler.schedule(("maintenance",), 30)
+    scheduler.schedule(("checkpoint",), checkpointinterval)
+    while not stopnow:
+        wakeup.clear()
+        for job in scheduler.poll():
+            run_job(transport, job, announce=lambda torrents: loop.create_task(announce(torrents)))
+        try:
+            await asyncio.wait_for(wakeup.wait(), scheduler.timeout())
+        except asyncio.TimeoutError:
+            pass
+
+def run_threaded(args):
+    global port
+    global tc
+    global stopnow
 
-    server = socketserver.UDPServer(("0.0.0.0", args.rafdpport), RAFDPHandler)
+    server = RAFDPServer(("0.0.0.0", args.rafdpport), RAFDPHandler)
     port = server.server_address[1]
     tc = TrackerClient(port)
     logging.info(f"RAFDP server listening on port {port}")
@@ -219,12 +836,19 @@ if __name__ == "__main__":
     background_thread.start()
 
     # MUST ALWAYS RUN ON 127.0.0.1 OTHERWISE SECURITY RISK
-    rpcserver = socketserver.UDPServer(("127.0.0.1", args.rpcport), RPCHandler)
+    rpcserver = socketserver.ThreadingUDPServer(("127.0.0.1", args.rpcport), RPCHandler)
+    rpcserver.daemon_threads = True
     logging.info(f"RAFDP RPC server listening on port {rpcserver.server_address[1]}")
     rpcserver_thread = threading.Thread(target=rpcserver.serve_forever)
     rpcserver_thread.daemon = True
     rpcserver_thread.start()
 
+    # Persistent connections (which can also stream raw data) are accepted over TCP on the same port number
+    connectionserver = ConnectionServer(("127.0.0.1", args.rpcport), ConnectionHandler)
+    connectionserver_thread = threading.Thread(target=connectionserver.serve_forever)
+    connectionserver_thread.daemon = True
+    connectionserver_thread.start()
+
     try:
         while True:
             time.sleep(1)
@@ -233,8 +857,107 @@ if __name__ == "__main__":
         server.shutdown()
         server_thread.join()
         stopnow = True
+        scheduler.notify()
         background_thread.join()
         rpcserver.shutdown()
         rpcserver_thread.join()
+        if treeindex is not None:
+            checkpoint()
+        connectionserver.shutdown()
+        connectionserver_thread.join()
+        tc.close()
+
+async def run_asyncio(args):
+    # The RAFDP protocol, RPC server and background scheduler all run in one event loop
+    global port
+    global tc
+
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(RAFDPProtocol, local_addr=("0.0.0.0", args.rafdpport))
+    port = transport.get_extra_info("sockname")[1]
+    tc = TrackerClient(port)
+    logging.info(f"RAFDP server (asyncio) listening on port {port}")
+
+    # MUST ALWAYS RUN ON 127.0.0.1 OTHERWISE SECURITY RISK
+    rpctransport, _ = await loop.create_datagram_endpoint(RPCProtocol, local_addr=("127.0.0.1", args.rpcport))
+    logging.info(f"RAFDP RPC server listening on port {rpctransport.get_extra_info('sockname')[1]}")
+    connectionserver = await asyncio.start_server(handle_connection_async, "127.0.0.1", args.rpcport)
+
+    try:
+        await background_async(transport)
+    finally:
+        if treeindex is not None:
+            checkpoint()
+        connectionserver.close()
+        rpctransport.close()
+        transport.close()
+        tc.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rpcport", type=int, nargs="?", default=7284, help="RPC port")
+    parser.add_argument("rafdpport", type=int, nargs="?", default=0, help="RAFDP port")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded", help="Run the servers on threads or in an asyncio event loop")
+    parser.add_argument("--fragmentsize", type=int, default=fragmentsize, help="Largest fragment of a leaf sent in one datagram to peers over the internet")
+    parser.add_argument("--lanfragmentsize", type=int, default=lanfragmentsize, help="Largest fragment of a leaf sent in one datagram to peers on this machine or LAN")
+    parser.add_argument("--reassemblytimeout", type=float, default=reassemble.timeout, help="Seconds before a partially received leaf is discarded")
+    parser.add_argument("--reassemblybudget", type=int, default=reassemble.maxbytes // (1024 * 1024), help="Maximum MiB used for partially received leaves")
+    parser.add_argument("--deadpeertimeout", type=int, default=deadpeertimeout, help="Seconds without hearing from a peer before it is forgotten")
+    parser.add_argument("--workers", type=int, default=workers, help="Number of processes used to hash added files")
+    parser.add_argument("--cachesize", type=int, default=overalltree.chunks.maxbytes // (1024 * 1024), help="Maximum MiB of downloaded chunks kept in memory before they are moved to disk")
+    parser.add_argument("--filepoolsize", type=int, default=overalltree.filepool.maxsize, help="Maximum number of shared files kept open (memory-mapped) at once")
+    parser.add_argument("--index", type=str, default=None, help="Path of the index of shared files (defaults to the temporary RAFDP folder)")
+    parser.add_argument("--noindex", action="store_true", help="Don't keep an index of shared files across restarts")
+    parser.add_argument("--store", type=str, default=None, help="Folder downloaded chunks are stored in (defaults to the temporary RAFDP folder)")
+    parser.add_argument("--nostore", action="store_true", help="Keep downloaded chunks in memory (and a temporary spill file) instead of the store")
+    args = parser.parse_args()
+    workers = args.workers
+    deadpeertimeout = args.deadpeertimeout
+    fragmentsize = args.fragmentsize
+    lanfragmentsize = args.lanfragmentsize
+    reassemble.timeout = args.reassemblytimeout
+    reassemble.maxbytes = args.reassemblybudget * 1024 * 1024
+    overalltree.filepool.maxsize = args.filepoolsize
+    overalltree.chunks.maxbytes = args.cachesize * 1024 * 1024
+
+    logname = Path(tempfile.gettempdir()) / "rafdp" / "logs" / (str(args.rpcport) + ".log")
+    logname.parent.mkdir(parents=True, exist_ok=True)
+    indexname = args.index
+    if indexname is None:
+        indexname = Path(tempfile.gettempdir()) / "rafdp" / "index" / (str(args.rpcport) + ".sqlite")
+        indexname.parent.mkdir(parents=True, exist_ok=True)
+    storename = args.store
+    if storename is None:
+        storename = Path(tempfile.gettempdir()) / "rafdp" / "store" / str(args.rpcport)
+    loglevel = logging.INFO
+
+    logging.basicConfig(
+        filename=logname,
+        filemode="w",
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=loglevel,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    logging.getLogger().addHandler(logging.StreamHandler())
+
+    fix_udp_macos()
+
+    if not args.nostore:
+        overalltree.chunks.store = BlobStore(storename, overalltree.filepool)
+    overalltree.onmissing = request_hash
+
+    if not args.noindex:
+        treeindex = TreeIndex(indexname)
+        index_thread = threading.Thread(target=load_index)
+        index_thread.daemon = True
+        index_thread.start()
+
+    if args.engine == "asyncio":
+        try:
+            asyncio.run(run_asyncio(args))
+        except KeyboardInterrupt:
+            logging.info("Halting RAFDP server...")
+    else:
+        run_threaded(args)
 
 logging.info("RAFDP server has successfully been shut down.")
\ No newline at end of file
@@ -6,22 +6,101 @@ import signal
 import json
 import socket
 import time
+import threading
+import queue
+import logging
 
 import utils
 
-def sendjson(port, data):
+def sendjson(port, data, timeout=5):
     data = json.dumps(data).encode("ascii")
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(5)
+        sock.settimeout(timeout)
         sock.sendto(data, ("127.0.0.1", port))
         result, _ = sock.recvfrom(60000)
     return json.loads(result.decode("ascii"))
 
+class RPCConnection:
+    # One TCP connection to the daemon which many threads can send requests over at once,
+    # replies (which may come back in any order) are matched up to requests by their id
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+        self.sendlock = threading.Lock()
+        self.nextid = 0
+        # request id -> queue of messages received for it
+        self.calls = {}
+        self.closed = False
+        self.thread = threading.Thread(target=self.reader, daemon=True)
+        self.thread.start()
+
+    def reader(self):
+        try:
+            while True:
+                requestid, messagetype, payload = utils.recvmessage(self.sock)
+                with self.lock:
+                    replies = self.calls.get(requestid)
+                if replies is not None:
+                    replies.put((messagetype, payload))
+        except OSError as e:
+            with self.lock:
+                self.closed = True
+                for replies in self.calls.values():
+                    replies.put((None, e))
+
+    def send(self, data):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection to RAFDP daemon closed")
+            requestid = self.nextid
+            self.nextid = (self.nextid + 1) % 2**32
+            replies = queue.Queue()
+            self.calls[requestid] = replies
+        with self.sendlock:
+            utils.sendmessage(self.sock, requestid, utils.REQUEST, json.dumps(data).encode("ascii"))
+        return requestid, replies
+
+    def receive(self, replies, timeout=None):
+        try:
+            messagetype, payload = replies.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout("timed out")
+        if messagetype is None:
+            raise payload
+        return messagetype, payload
+
+    def finish(self, requestid):
+        with self.lock:
+            self.calls.pop(requestid, None)
+
+    def call(self, data, timeout=5):
+        requestid, replies = self.send(data)
+        try:
+            messagetype, payload = self.receive(replies, timeout)
+            return json.loads(payload.decode("ascii"))
+        finally:
+            self.finish(requestid)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
 class RAFDPProcess:
-    def __init__(self, rpcport, openprocess=True, newconsole=False, delay=0.01):
+    def __init__(self, rpcport, openprocess=True, newconsole=False, delay=0.01, engine="threaded"):
         self.rpcport = rpcport
         self.delay = delay
+        self.engine = engine
         self.hashstatscache = {}
+        # old daemons don't support the getchunk method or streaming ranges
+        self.getchunksupported = True
+        self.readrangesupported = True
+        self.waithashsupported = True
+        self.connection = None
+        self.connectionlock = threading.Lock()
         if openprocess:
             self.open(newconsole=newconsole)
 
@@ -33,47 +112,74 @@ class RAFDPProcess:
             pythonexe = "python"
         else:
             pythonexe = "python3"
+        arguments = ["rafdp.py", port, "--engine", self.engine]
         if not newconsole:
-            self.process = subprocess.Popen([pythonexe, "rafdp.py", port])
+            self.process = subprocess.Popen([pythonexe, *arguments])
         else:
             if os.name == "nt":
-                self.process = subprocess.Popen(["cmd", "/k", pythonexe, "rafdp.py", port], creationflags=subprocess.CREATE_NEW_CONSOLE)
+                self.process = subprocess.Popen(["cmd", "/k", pythonexe, *arguments], creationflags=subprocess.CREATE_NEW_CONSOLE)
             else:
-                self.process = subprocess.Popen(["gnome-terminal", "--", "python3", "rafdp.py", port])
+                self.process = subprocess.Popen(["gnome-terminal", "--", "python3", *arguments])
 
     def close(self):
         if platform.system() == "Linux":
             os.kill(self.getpid(), signal.SIGTERM)
         self.process.terminate()
+        if self.connection is not None:
+            self.connection.close()
+
+    def connect(self):
+        with self.connectionlock:
+            if self.connection is None or self.connection.closed:
+                self.connection = RPCConnection(self.rpcport)
+            return self.connection
+
+    def request(self, data, timeout=5):
+        try:
+            connection = self.connect()
+        except ConnectionRefusedError:
+            # daemons without persistent connections only have the UDP endpoint
+            return sendjson(self.rpcport, data, timeout)
+        return connection.call(data, timeout)
 
     def getport(self):
-        result = sendjson(self.rpcport, {"method": "getport"})
+        result = self.request({"method": "getport"})
         if not result["success"]:
             raise Exception(result)
         return result["port"]
 
     def getpid(self):
-        result = sendjson(self.rpcport, {"method": "getpid"})
+        result = self.request({"method": "getpid"})
         if not result["success"]:
             raise Exception(result)
         return result["pid"]
 
     def addpeer(self, address, port):
-        result = sendjson(self.rpcport, {"method": "addpeer", "ip": address, "port": port})
+        result = self.request({"method": "addpeer", "ip": address, "port": port})
         return result["success"]
 
-    def addfile(self, filename):
-        result = sendjson(self.rpcport, {"method": "addfile", "filename": filename})
+    def addfile(self, filename, workers=None):
+        result = self.request({"method": "addfile", "filename": filename, "workers": workers})
         if not result["success"]:
             raise Exception(result)
         return result["hash"]
 
     def addhash(self, thehash):
-        result = sendjson(self.rpcport, {"method": "addhash", "hash": thehash})
+        result = self.request({"method": "addhash", "hash": thehash})
         return result["success"]
 
     def gethash(self, thehash):
-        result = sendjson(self.rpcport, {"method": "gethash", "hash": thehash})
+        result = self.request({"method": "gethash", "hash": thehash})
+        return self.decodehash(result)
+
+    def waithash(self, thehash, timeout=30):
+        # Like gethash but the daemon replies as soon as the hash is received (or None after timeout seconds)
+        result = self.request({"method": "waithash", "hash": thehash, "timeout": timeout}, timeout + 5)
+        if result.get("error") == "unknown method":
+            raise NotImplementedError(result)
+        return self.decodehash(result)
+
+    def decodehash(self, result):
         if result["success"]:
             thehash = result["hashed"]
             if result["encoded"]:
@@ -82,27 +188,94 @@ class RAFDPProcess:
         else:
             return None
 
+    def waitforhash(self, thehash, delay=None):
+        if delay is None:
+            delay = self.delay
+
+        if self.waithashsupported:
+            try:
+                result = self.waithash(thehash)
+                while result is None:
+                    result = self.waithash(thehash)
+                return result
+            except (socket.timeout, NotImplementedError):
+                # old daemons can only be polled
+                self.waithashsupported = False
+        result = self.gethash(thehash)
+        while result is None:
+            time.sleep(delay)
+            result = self.gethash(thehash)
+        return result
+
+    def getchunk(self, thehash, index, highestindex, timeout=None):
+        request = {"method": "getchunk", "hash": thehash, "index": index, "highestindex": highestindex, "timeout": timeout}
+        result = self.request(request, 5 if timeout is None else timeout + 5)
+        if result.get("error") == "unknown method":
+            raise NotImplementedError(result)
+        if result["success"]:
+            return base64.b64decode(result["chunk"])
+        else:
+            return None
+
+    def readrange(self, thehash, offset, size, timeout=None):
+        # Raw bytes of a range of thehash streamed over the connection instead of base64 encoded JSON datagrams
+        connection = self.connect()
+        requestid, replies = connection.send({"method": "readrange", "hash": thehash, "offset": offset, "size": size, "timeout": timeout})
+        try:
+            if timeout is not None:
+                timeout += 5
+            _, header = connection.receive(replies, timeout)
+            header = json.loads(header.decode("ascii"))
+            if not header["success"]:
+                raise Exception(header)
+            data = bytearray()
+            while True:
+                messagetype, payload = connection.receive(replies, timeout)
+                if messagetype == utils.END:
+                    break
+                data += payload
+        finally:
+            connection.finish(requestid)
+        if len(data) != header["size"]:
+            raise Exception(f"Expected {header['size']} bytes, only got {len(data)}")
+        return bytes(data)
+
     def addurl(self, url):
-        result = sendjson(self.rpcport, {"method": "addurl", "url": url})
+        result = self.request({"method": "addurl", "url": url})
         if not result["success"]:
             raise Exception(result)
         return result["success"]
 
     def getpeers(self):
-        result = sendjson(self.rpcport, {"method": "getpeers"})
+        result = self.request({"method": "getpeers"})
+        if not result["success"]:
+            raise Exception(result)
+        return result["peers"]
+
+    def getpeerstats(self):
+        result = self.request({"method": "getpeerstats"})
         if not result["success"]:
             raise Exception(result)
         return result["peers"]
 
+    def getfilepoolstats(self):
+        result = self.request({"method": "getfilepoolstats"})
+        if not result["success"]:
+            raise Exception(result)
+        return result["stats"]
+
+    def getcachestats(self):
+        result = self.request({"method": "getcachestats"})
+        if not result["success"]:
+            raise Exception(result)
+        return result["stats"]
+
     def getoutermosthash(self, thehash, last=False, delay=None):
         if delay is None:
             delay = self.delay
 
         while True:
-            result = self.gethash(thehash)
-            while result is None:
-                time.sleep(delay)
-                result = self.gethash(thehash)
+            result = self.waitforhash(thehash, delay=delay)
             if type(result) is str and result.startswith("RAFDP") and ",RAFDP" in result:
                 thehash = result.split(",")[int(last)]
             elif type(result) is str:
@@ -119,18 +292,25 @@ class RAFDPProcess:
         if delay is None:
             delay = self.delay
 
+        if self.getchunksupported:
+            try:
+                result = self.getchunk(thehash, index, highestindex, timeout=30)
+                while result is None:
+                    time.sleep(delay)
+                    result = self.getchunk(thehash, index, highestindex, timeout=30)
+                chunkindex, result = utils.fromvarint(result)
+                assert chunkindex == index, f"Expected {index} as index, got {chunkindex} instead"
+                return result
+            except (socket.timeout, NotImplementedError):
+                # fall back to walking down the tree with gethash
+                self.getchunksupported = False
+
         if highestindex != 0:
             directionlist = bin(index)[2:].zfill(len(bin(highestindex)[2:]))
             for direction in directionlist:
-                result = self.gethash(thehash)
-                while result is None:
-                    time.sleep(delay)
-                    result = self.gethash(thehash)
+                result = self.waitforhash(thehash, delay=delay)
                 thehash = result.split(",")[int(direction)]
-        result = self.gethash(thehash)
-        while result is None:
-            time.sleep(delay)
-            result = self.gethash(thehash)
+        result = self.waitforhash(thehash, delay=delay)
 
         assert type(result) is bytes
         chunkindex, result = utils.fromvarint(result)
@@ -156,6 +336,12 @@ class RAFDPProcess:
         if delay is None:
             delay = self.delay
 
+        if self.readrangesupported:
+            try:
+                return self.readrange(thehash, offset, size)
+            except ConnectionRefusedError:
+                self.readrangesupported = False
+
         chunksize, lastchunksize, numchunks, estfilesize = self.gethashstats(thehash, delay=delay)
         if offset > estfilesize:
             offset = estfilesize
@@ -169,4 +355,106 @@ class RAFDPProcess:
         for index in range(startindex, endindex):
             gathereddata += self.getchunkofhashbyindex(thehash, index, numchunks - 1, delay=delay)
         gathereddata = gathereddata[offset - (startindex * chunksize):][0:size]
-        return gathereddata
\ No newline at end of file
+        return gathereddata
+class ReadAhead:
+    # Reads ranges of a hash, prefetching the chunks after sequential reads in the background.
+    # The number of chunks prefetched doubles while reads are sequential and halves when they aren't
+    def __init__(self, daemon, thehash, minwindow=2, maxwindow=64, threads=4):
+        self.daemon = daemon
+        self.thehash = thehash
+        self.minwindow = minwindow
+        self.maxwindow = maxwindow
+        self.window = minwindow
+        self.numthreads = threads
+        self.threads = []
+        self.nextoffset = 0
+        self.position = 0
+        # chunk index -> data, and the indices being prefetched
+        self.buffer = {}
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.queue = queue.Queue()
+        self.closed = False
+
+    def read(self, offset, size):
+        chunksize, lastchunksize, numchunks, estfilesize = self.daemon.gethashstats(self.thehash)
+        offset = min(offset, estfilesize)
+        size = min(size, estfilesize - offset)
+        if size <= 0:
+            return b""
+        startindex = offset // chunksize
+        endindex = (offset + size - 1) // chunksize
+
+        sequential = offset == self.nextoffset
+        self.nextoffset = offset + size
+        with self.condition:
+            self.position = startindex
+            if sequential:
+                self.window = min(self.window * 2, self.maxwindow)
+            else:
+                self.window = max(self.window // 2, self.minwindow)
+            # chunks behind the reader or too far ahead of it won't be used
+            for index in [index for index in self.buffer if index < startindex or index > endindex + self.maxwindow]:
+                del self.buffer[index]
+        if sequential:
+            self.prefetch(range(endindex + 1, min(endindex + 1 + self.window, numchunks)), numchunks)
+
+        # chunks that aren't buffered or being prefetched are read in one go
+        with self.condition:
+            missing = [index for index in range(startindex, endindex + 1) if index not in self.buffer and index not in self.pending]
+        if missing:
+            first, last = missing[0], missing[-1]
+            data = self.daemon.getsizeoffsetfromhash(self.thehash, (last - first + 1) * chunksize, first * chunksize)
+            with self.condition:
+                for index in range(first, last + 1):
+                    self.buffer.setdefault(index, data[(index - first) * chunksize:(index - first + 1) * chunksize])
+
+        gathereddata = b"".join(self.getchunk(index, numchunks) for index in range(startindex, endindex + 1))
+        return gathereddata[offset - (startindex * chunksize):][0:size]
+
+    def getchunk(self, index, numchunks):
+        with self.condition:
+            while index in self.pending:
+                self.condition.wait()
+            if index in self.buffer:
+                return self.buffer[index]
+        return self.daemon.getchunkofhashbyindex(self.thehash, index, numchunks - 1)
+
+    def prefetch(self, indices, numchunks):
+        with self.condition:
+            for index in indices:
+                if index not in self.buffer and index not in self.pending:
+                    self.pending.add(index)
+                    self.queue.put((index, numchunks))
+        while len(self.threads) < self.numthreads:
+            thread = threading.Thread(target=self.prefetcher, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def prefetcher(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            index, numchunks = item
+            data = None
+            with self.condition:
+                # skip chunks the reader has moved past since they were queued
+                wanted = not self.closed and index >= self.position
+            if wanted:
+                try:
+                    data = self.daemon.getchunkofhashbyindex(self.thehash, index, numchunks - 1)
+                except Exception as e:
+                    logging.warning(f"Prefetching chunk {index} of {self.thehash} failed: {e}")
+            with self.condition:
+                self.pending.discard(index)
+                if data is not None and not self.closed:
+                    self.buffer[index] = data
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.buffer.clear()
+        for thread in self.threads:
+            self.queue.put(None)
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class PartialLeaf:
+    def __init__(self, numfragments):
+        self.numfragments = numfragments
+        self.fragmentsize = None
+        self.buffer = None
+        self.view = None
+        self.received = bytearray((numfragments + 7) // 8)
+        self.numreceived = 0
+        self.lastfragment = None
+        self.lastupdated = time.monotonic()
+
+    def has(self, index):
+        return self.received[index // 8] & (1 << (7 - index % 8))
+
+    def missing_bitmap(self):
+        bitmap = bytearray(len(self.received))
+        for index in range(self.numfragments):
+            if not self.has(index):
+                bitmap[index // 8] |= 1 << (7 - index % 8)
+        return bytes(bitmap)
+
+class ReassemblyBuffer:
+    # Holds partially received leaves, each in one preallocated buffer with a bitmap of the
+    # fragments received, entries expire after timeout seconds and the least recently updated
+    # are evicted when the buffers would take up more than maxbytes
+    def __init__(self, maxleafsize, maxbytes=64 * 1024 * 1024, timeout=30):
+        self.maxleafsize = maxleafsize
+        self.maxbytes = maxbytes
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, index, numfragments, data):
+        # Returns a view of the whole leaf once all of its fragments have been received
+        with self.lock:
+            self._expire()
+            if numfragments < 1 or not 0 <= index < numfragments:
+                return None
+            entry = self.entries.get(key)
+            if entry is None or entry.numfragments != numfragments:
+                self._remove(key)
+                entry = PartialLeaf(numfragments)
+                self.entries[key] = entry
+            if entry.has(index):
+                return None
+            entry.lastupdated = time.monotonic()
+            self.entries.move_to_end(key)
+
+            islast = index == numfragments - 1
+            if entry.fragmentsize is None:
+                if islast and numfragments > 1:
+                    # Can't tell where it goes until the size of the other fragments is known
+                    entry.lastfragment = bytes(data)
+                    self._mark(entry, index)
+                    return None
+                if not self._allocate(key, entry, len(data)):
+                    return None
+                if entry.lastfragment is not None:
+                    lastfragment, entry.lastfragment = entry.lastfragment, None
+                    if len(lastfragment) > entry.fragmentsize:
+                        self._remove(key)
+                        return None
+                    self._write(entry, numfragments - 1, lastfragment)
+            if (not islast and len(data) != entry.fragmentsize) or len(data) > entry.fragmentsize:
+                # Doesn't fit with the fragments received so far
+                self._remove(key)
+                return None
+            self._write(entry, index, data)
+            self._mark(entry, index)
+
+            if entry.numreceived == numfragments:
+                self._remove(key)
+                return entry.view
+            return None
+
+    def missing(self, key):
+        # Returns the fragment size and a bitmap of the fragments not yet received
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.fragmentsize is None:
+                return None
+            return entry.fragmentsize, entry.missing_bitmap()
+
+    def _allocate(self, key, entry, fragmentsize):
+        capacity = entry.numfragments * fragmentsize
+        if fragmentsize < 1 or (entry.numfragments - 1) * fragmentsize >= self.maxleafsize or capacity > self.maxbytes:
+            self._remove(key)
+            return False
+        while self.size + capacity > self.maxbytes and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+        entry.fragmentsize = fragmentsize
+        entry.buffer = bytearray(capacity)
+        entry.view = memoryview(entry.buffer)[0:0]
+        self.size += capacity
+        return True
+
+    def _write(self, entry, index, data):
+        offset = index * entry.fragmentsize
+        entry.buffer[offset:offset + len(data)] = data
+        if index == entry.numfragments - 1:
+            entry.view = memoryview(entry.buffer)[0:offset + len(data)]
+
+    def _mark(self, entry, index):
+        entry.received[index // 8] |= 1 << (7 - index % 8)
+        entry.numreceived += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry.buffer is not None:
+            self.size -= len(entry.buffer)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if (now - entry.lastupdated) < self.timeout:
+                break
+            self._remove(key)
@@ -0,0 +1,70 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Scheduler:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.deadlines = {}
+        self.counter = itertools.count()
+        self.woken = False
+        # Called (from any thread) whenever wait would have been woken up, e.g. to wake an event loop
+        self.onwake = None
+
+    def schedule(self, job, delay=0):
+        # Rescheduling a job replaces its previous deadline
+        deadline = time.monotonic() + delay
+        with self.condition:
+            self.deadlines[job] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.counter), job))
+            if self.heap[0][0] == deadline:
+                self.condition.notify()
+                if self.onwake is not None:
+                    self.onwake()
+
+    def cancel(self, job):
+        with self.condition:
+            self.deadlines.pop(job, None)
+
+    def is_scheduled(self, job):
+        return job in self.deadlines
+
+    def notify(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify()
+            if self.onwake is not None:
+                self.onwake()
+
+    def poll(self):
+        # Returns the jobs that are due (cancelled and replaced deadlines are skipped)
+        due = []
+        with self.condition:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, job = heapq.heappop(self.heap)
+                if self.deadlines.get(job) == deadline:
+                    del self.deadlines[job]
+                    due.append(job)
+            self.woken = False
+        return due
+
+    def timeout(self):
+        # Seconds until the next job is due, None if nothing is scheduled
+        with self.condition:
+            if not self.heap:
+                return None
+            return max(0, self.heap[0][0] - time.monotonic())
+
+    def wait(self):
+        # Blocks until a job is due or notify is called
+        with self.condition:
+            while not self.woken:
+                timeout = self.timeout()
+                if timeout == 0:
+                    break
+                self.condition.wait(timeout)
+        return self.poll()
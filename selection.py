@@ -0,0 +1,117 @@
+import heapq
+import itertools
+import threading
+
+
+class PieceSelector:
+    # Assigns each missing hash to one peer (or to two peers once only a few hashes are left),
+    # preferring the hashes that the fewest peers are known to have
+    endgame = 8
+    endgamepeers = 2
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.wanted = set()
+        # hash -> peers known to have it (e.g. because they sent its parent), unknown means any peer
+        self.available = {}
+        self.assigned = {}
+        self.lastfailed = {}
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def rarity(self, thehash):
+        available = self.available.get(thehash)
+        if not available:
+            return float("inf")
+        return len(available)
+
+    def _push(self, thehash):
+        entry = next(self.counter)
+        self.entries[thehash] = entry
+        heapq.heappush(self.heap, (self.rarity(thehash), entry, thehash))
+
+    def add(self, thehash):
+        with self.lock:
+            if thehash not in self.wanted:
+                self.wanted.add(thehash)
+                self._push(thehash)
+
+    def learn(self, peer, hashes):
+        # peer is known to have hashes
+        with self.lock:
+            for thehash in hashes:
+                self.available.setdefault(thehash, set()).add(peer)
+                if thehash in self.wanted and not self.assigned.get(thehash):
+                    self._push(thehash)
+
+    def is_assigned(self, thehash):
+        return bool(self.assigned.get(thehash))
+
+    def _eligible(self, peer, thehash, numpeers):
+        available = self.available.get(thehash)
+        if available and peer not in available:
+            return False
+        if self.lastfailed.get(thehash) == peer and numpeers > 1:
+            return False
+        return True
+
+    def next(self, peer, numpeers):
+        # Returns the rarest unassigned hash peer can be asked for (and assigns it to peer), or None
+        with self.lock:
+            skipped = []
+            chosen = None
+            while self.heap:
+                item = heapq.heappop(self.heap)
+                _, entry, thehash = item
+                if self.entries.get(thehash) != entry or thehash not in self.wanted or self.assigned.get(thehash):
+                    continue
+                if self._eligible(peer, thehash, numpeers):
+                    chosen = thehash
+                    del self.entries[thehash]
+                    break
+                skipped.append(item)
+            for item in skipped:
+                heapq.heappush(self.heap, item)
+
+            if chosen is None and len(self.assigned) <= self.endgame:
+                # Endgame, the last few hashes are also requested from another peer
+                for thehash, assignedpeers in self.assigned.items():
+                    if peer not in assignedpeers and len(assignedpeers) < self.endgamepeers and self._eligible(peer, thehash, numpeers):
+                        chosen = thehash
+                        break
+
+            if chosen is not None:
+                self.assigned.setdefault(chosen, set()).add(peer)
+            return chosen
+
+    def release(self, peer, thehash, failed=False):
+        # peer is no longer being asked for thehash (failed if it timed out), so it can be assigned again
+        with self.lock:
+            assignedpeers = self.assigned.get(thehash)
+            if assignedpeers is not None:
+                assignedpeers.discard(peer)
+                if not assignedpeers:
+                    del self.assigned[thehash]
+            if failed:
+                self.lastfailed[thehash] = peer
+                available = self.available.get(thehash)
+                if available is not None:
+                    available.discard(peer)
+            if thehash in self.wanted and thehash not in self.assigned:
+                self._push(thehash)
+
+    def release_peer(self, peer):
+        with self.lock:
+            for thehash in [thehash for thehash, assignedpeers in self.assigned.items() if peer in assignedpeers]:
+                self.release(peer, thehash)
+            for available in self.available.values():
+                available.discard(peer)
+
+    def received(self, thehash):
+        with self.lock:
+            self.wanted.discard(thehash)
+            self.available.pop(thehash, None)
+            self.lastfailed.pop(thehash, None)
+            self.entries.pop(thehash, None)
+            return self.assigned.pop(thehash, set())
@@ -1,10 +1,22 @@
 import time
 import random
 import os
+import json
+import struct
+import socketserver
 
 import utils
-from rafdplib import RAFDPProcess
+from rafdplib import RAFDPProcess, ReadAhead, sendjson
 from core import MerkleTree
+from treeindex import TreeIndex, filestat
+from filepool import FilePool
+from chunkcache import ChunkCache
+from blobstore import BlobStore
+from congestion import CongestionWindow
+from reassembly import ReassemblyBuffer
+from selection import PieceSelector
+from peerstats import PeerStats
+from trackerclient import TrackerClient
 from utils import MemFS, encode_peers
 
 from flask import Flask, request
@@ -32,7 +44,255 @@ def test_merkle_tree():
         foundresult = tree.get(findthis, expandtuple=False)[1]
         newtree.set(findthis, foundresult)
 
-    assert sorted(tree.tree.items()) == sorted(newtree.tree.items())
+    assert len(tree) == len(newtree)
+    for key in newtree.tree:
+        assert tree.get(key) == newtree.get(key)
+
+def test_merkle_tree_parallel():
+    tree = MerkleTree()
+    roothash = tree.generate_tree("greatexpectations.txt")
+
+    paralleltree = MerkleTree()
+    assert paralleltree.generate_tree("greatexpectations.txt", workers=4) == roothash
+    assert tree.filetrees == paralleltree.filetrees
+
+def test_file_tree():
+    tree = MerkleTree()
+    roothash = tree.generate_tree("greatexpectations.txt")
+    filetree = tree.filetrees[0]
+    assert tree.tree == {}
+    assert len(tree) == len(filetree) == sum(len(level) // 32 for level in filetree.levels)
+    assert filetree.find(MerkleTree.decode_hash(roothash)) == (len(filetree.levels) - 1, 0)
+    assert tree.get(filetree.digest(0, 3)) == (2, ("greatexpectations.txt", 3, MerkleTree.chunk_size))
+    typeid, node = tree.get(filetree.digest(1, 0))
+    assert node == MerkleTree.encode_hash(filetree.digest(0, 0)) + "," + MerkleTree.encode_hash(filetree.digest(0, 1))
+    assert filetree.find(MerkleTree.digest(b"not in the tree")) is None
+
+    # a hash that was wanted before the file was added stops being missing
+    othertree = MerkleTree()
+    othertree.set(roothash)
+    assert othertree.is_missing(roothash)
+    othertree.generate_tree("greatexpectations.txt")
+    assert not othertree.is_missing(roothash) and othertree.is_complete()
+    assert othertree.get(roothash) == tree.get(roothash)
+
+def test_hash_encoding():
+    from multiformats import multibase, multihash
+    data = os.urandom(random.randint(0, 100))
+    thehash = MerkleTree.generate_hash(data)
+    assert thehash == "RAFDP10" + multibase.encode(multihash.digest(data, "sha2-256"), "base58btc")
+    assert MerkleTree.decode_hash(thehash) == MerkleTree.digest(data)
+    with pytest.raises(ValueError):
+        MerkleTree.decode_hash(thehash[:-1])
+
+    child = MerkleTree.generate_hash(b"child")
+    tree = MerkleTree()
+    tree.set(thehash, child + "," + child)
+    assert tree.get(thehash) == (1, child + "," + child)
+    assert tree.get_missing() == [child]
+    assert not tree.key_in_tree("RAFDP10notahash")
+
+def test_tree_index(tmp_path):
+    filename = tmp_path / "greatexpectations.txt"
+    with open("greatexpectations.txt", "rb") as file:
+        filename.write_bytes(file.read())
+    path = str(filename)
+
+    tree = MerkleTree()
+    stat = filestat(path)
+    roothash, nodes = tree.hash_file(path)
+
+    index = TreeIndex(tmp_path / "index.sqlite")
+    index.add(path, roothash, nodes, stat)
+
+    reopened = TreeIndex(tmp_path / "index.sqlite")
+    assert reopened.files() == [path]
+    assert reopened.lookup(path) == roothash
+    assert reopened.load(path, MerkleTree.chunk_size) == nodes
+
+    with open(path, "ab") as file:
+        file.write(b"changed")
+    assert reopened.lookup(path) is None
+
+def test_file_pool():
+    pool = FilePool(maxsize=1)
+    with open("greatexpectations.txt", "rb") as file:
+        file.seek(100)
+        data = file.read(50)
+
+    with pool.read("greatexpectations.txt", 100, 50) as view:
+        assert view == data
+    assert pool.read("greatexpectations.txt", 100, 50) == data
+    pool.read("cat.jpg", 0, 10)
+    assert pool.stats() == {"open": 1, "maxsize": 1, "hits": 1, "misses": 2}
+    pool.close()
+
+def test_chunk_cache(tmp_path):
+    cache = ChunkCache(maxbytes=100, directory=tmp_path)
+    for i in range(5):
+        cache.add(i, bytes([i]) * 40)
+    # only the two most recently added fit in memory, the rest were moved to disk
+    assert list(cache.memory) == [3, 4]
+    assert sorted(cache.spilled) == [0, 1, 2]
+    assert len(cache) == 5
+
+    assert cache.get(1) == bytes([1]) * 40
+    assert cache.stats()["diskhits"] == 1
+    assert list(cache.memory) == [4, 1]
+    # 1 was already on disk so it isn't written out again
+    assert cache.stats()["spillbytes"] == 160
+    assert cache.get(4) == bytes([4]) * 40 and cache.stats()["hits"] == 1
+
+    cache.discard(0)
+    assert 0 not in cache and cache.get(0) is None
+    cache.close()
+
+def test_blob_store(tmp_path):
+    store = BlobStore(tmp_path)
+    store.segmentsize = 200
+    blobs = {MerkleTree.digest(bytes([i])): bytes([i]) * 100 for i in range(5)}
+    for key, data in blobs.items():
+        store.put(key, data)
+    assert store.stats()["segments"] == 5
+    for key, data in blobs.items():
+        assert isinstance(store.get(key), memoryview) and store.get(key) == data
+    assert store.get(MerkleTree.digest(b"not stored")) is None
+    store.close()
+
+    # a leaf that was only partly written is dropped when the store is opened again
+    with open(store.segmentname(4), "ab") as file:
+        file.write(BlobStore.header.pack(MerkleTree.digest(b"partial"), 100) + b"only part")
+    reopened = BlobStore(tmp_path)
+    assert len(reopened) == 5 and MerkleTree.digest(b"partial") not in reopened
+    assert all(reopened.get(key) == data for key, data in blobs.items())
+    reopened.put(MerkleTree.digest(b"after"), b"after")
+    assert reopened.get(MerkleTree.digest(b"after")) == b"after"
+
+    tree = MerkleTree(store=reopened)
+    thehash = MerkleTree.generate_hash(b"leaf")
+    tree.set(thehash, b"leaf", setmissing=False)
+    assert tree.get(thehash) == (3, b"leaf")
+    assert MerkleTree.decode_hash(thehash) in reopened
+
+    # restored leaves are only checked against their hash when they are first read
+    wanted = []
+    restored = MerkleTree(store=reopened)
+    restored.onmissing = wanted.append
+    restored.restore_leaf(thehash)
+    corrupt = MerkleTree.generate_hash(b"corrupt")
+    reopened.put(MerkleTree.decode_hash(corrupt), b"not what was hashed")
+    restored.restore_leaf(corrupt)
+    assert restored.is_complete()
+    assert restored.get(thehash) == (3, b"leaf")
+    assert restored.get(corrupt) == (5, None)
+    assert wanted == [corrupt] and restored.is_missing(corrupt)
+    reopened.close()
+
+def test_congestion_window():
+    window = CongestionWindow()
+    for i in range(window.initialwindow):
+        assert window.can_send()
+        window.on_send(i)
+    assert not window.can_send()
+
+    # slow start grows the window by one per acknowledged request
+    assert window.on_ack(0)
+    assert window.window == window.initialwindow + 1
+    assert window.srtt is not None and window.minrto <= window.rto <= window.maxrto
+
+    # losses halve the window (once per round trip) and back off the timeout
+    rto, size = window.rto, window.window
+    assert window.on_timeout(1)
+    assert window.on_timeout(2)
+    assert window.window == size / 2
+    assert window.rto == rto * 2
+
+    # retransmitted requests aren't used to measure the round trip time
+    window.on_send(1)
+    srtt = window.srtt
+    assert window.on_ack(1)
+    assert window.srtt == srtt
+    assert window.release(3)
+    assert not window.on_ack(3)
+
+def test_reassembly_buffer():
+    leaf = os.urandom(MerkleTree.chunk_size + 3)
+    fragmentsize = 1000
+    fragments = [leaf[i:i + fragmentsize] for i in range(0, len(leaf), fragmentsize)]
+    numfragments = len(fragments)
+
+    buffer = ReassemblyBuffer(MerkleTree.chunk_size + 16)
+    order = list(range(numfragments))
+    order.remove(numfragments - 1)
+    random.shuffle(order)
+    # the last fragment arriving first is kept until the fragment size is known
+    order.insert(0, numfragments - 1)
+    for index in order[:-1]:
+        assert buffer.add("leaf", index, numfragments, fragments[index]) is None
+    chunksize, bitmap = buffer.missing("leaf")
+    assert chunksize == fragmentsize
+    missing = [index for index in range(numfragments) if bitmap[index // 8] & (1 << (7 - index % 8))]
+    assert missing == [order[-1]]
+    assert buffer.add("leaf", order[-1], numfragments, fragments[order[-1]]) == leaf
+    assert len(buffer) == 0 and buffer.size == 0
+
+    # entries expire and the byte budget is enforced
+    buffer = ReassemblyBuffer(MerkleTree.chunk_size + 16, maxbytes=numfragments * fragmentsize, timeout=0.1)
+    buffer.add("first", 0, numfragments, fragments[0])
+    buffer.add("second", 0, numfragments, fragments[0])
+    assert buffer.missing("first") is None and buffer.missing("second") is not None
+    time.sleep(0.2)
+    buffer.add("third", 0, numfragments, fragments[0])
+    assert len(buffer) == 1
+
+    # fragments that don't fit a leaf are rejected
+    assert buffer.add("spoofed", 0, 1000, b"x" * fragmentsize) is None
+    assert buffer.missing("spoofed") is None
+
+def test_piece_selector():
+    selector = PieceSelector()
+    selector.endgame = 0
+    for thehash in ["common", "rare", "unknown"]:
+        selector.add(thehash)
+    selector.learn("first", ["common", "rare"])
+    selector.learn("second", ["common"])
+
+    # rarest first and every hash only assigned to one peer
+    assert selector.next("first", 2) == "rare"
+    assert selector.next("second", 2) == "common"
+    assert selector.next("second", 2) == "unknown"
+    assert selector.next("first", 2) is None
+
+    # a peer that times out is given up on in favour of the other one
+    selector.release("second", "unknown", failed=True)
+    assert selector.next("second", 2) is None
+    assert selector.next("first", 2) == "unknown"
+    assert selector.received("unknown") == {"first"}
+
+    # endgame, the last hashes are also requested from a second peer (if it has them)
+    selector.endgame = 8
+    assert selector.next("second", 2) is None
+    assert selector.next("first", 2) == "common"
+    assert selector.received("common") == {"first", "second"}
+
+def test_peer_stats():
+    fast, slow = PeerStats(), PeerStats()
+    fast.add_rtt(0.01)
+    slow.add_rtt(0.5)
+    assert fast.score() > slow.score()
+
+    for _ in range(20):
+        slow.add_outcome(True)
+    assert slow.loss > 0.9
+    slow.add_outcome(False)
+    assert slow.loss < 0.9
+
+    fast.throughputinterval = 0
+    fast.add_delivered(16384)
+    assert fast.throughput > 0
+    assert fast.idle() < 1
+    fast.heard()
+    assert fast.as_dict()["lastheard"] is not None
 
 def generate_test_range(estfilesize, chunksize, startinrange=True, endinrange=True, condition=0):
     """
@@ -118,8 +378,9 @@ class Test_RAFDP_Processes:
             newtree.set(findthis, result)
 
         chunks = {}
-        for item in newtree.tree.values():
-            if type(item) == bytes:
+        for key in newtree.tree:
+            typeid, item = newtree.get(key)
+            if typeid == 3:
                 chunkindex, item = utils.fromvarint(item)
                 chunks[chunkindex] = item
         gathereddata = b"".join(chunks[key] for key in sorted(chunks))
@@ -154,6 +415,184 @@ class Test_RAFDP_Processes:
         print(inrange, condition, len(data))
         assert gathereddata == data
 
+    def test_rafdp_get_chunk(self):
+        first, second = self.first, self.second
+
+        filename = "greatexpectations.txt"
+        roothash = first.addfile(filename)
+        assert second.addpeer("127.0.0.1", first.getport())
+        assert second.addhash(roothash)
+        with open(filename, "rb") as file:
+            data = file.read()
+
+        chunksize, lastchunksize, numchunks, estfilesize = second.gethashstats(roothash)
+        for index in [0, numchunks - 1, numchunks // 2, numchunks // 2]:
+            chunk = second.getchunkofhashbyindex(roothash, index, numchunks - 1)
+            assert chunk == data[index * chunksize:(index + 1) * chunksize]
+        assert second.getchunksupported
+
+        # unknown methods get an error back instead of no reply
+        result = sendjson(second.rpcport, {"method": "notamethod"})
+        assert not result["success"] and result["error"] == "unknown method"
+
+    def test_rafdp_read_range(self):
+        first, second = self.first, self.second
+
+        filename = "greatexpectations.txt"
+        roothash = first.addfile(filename)
+        assert second.addpeer("127.0.0.1", first.getport())
+        assert second.addhash(roothash)
+        with open(filename, "rb") as file:
+            data = file.read()
+
+        assert second.readrange(roothash, 0, len(data) + 100) == data
+        assert second.readrange(roothash, 100000, 50000) == data[100000:150000]
+        assert second.readrangesupported
+
+        # a hash nobody has times out
+        with pytest.raises(Exception):
+            second.readrange(MerkleTree.generate_hash(b"nobody has this"), 0, 10, timeout=0.5)
+
+    def test_rafdp_wait_hash(self):
+        first, second = self.first, self.second
+
+        roothash = first.addfile("cat.jpg")
+        assert second.addpeer("127.0.0.1", first.getport())
+        result = second.waithash(roothash, timeout=10)
+        assert result == first.gethash(roothash)
+        assert second.waithashsupported
+
+        # a hash nobody has returns None once the timeout is up
+        started = time.time()
+        assert second.waithash(MerkleTree.generate_hash(b"nobody has this"), timeout=0.5) is None
+        assert 0.5 <= time.time() - started < 5
+
+    def test_rafdp_persistent_connection(self):
+        second = self.second
+
+        port = second.getport()
+        connection = second.connect()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(second.getport())) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [port] * 20
+        assert second.connect() is connection
+
+        # pipelined requests are matched up to their replies by id
+        pidid, pidreplies = connection.send({"method": "getpid"})
+        portid, portreplies = connection.send({"method": "getport"})
+        assert json.loads(connection.receive(portreplies, 5)[1])["port"] == port
+        assert json.loads(connection.receive(pidreplies, 5)[1])["pid"] == second.getpid()
+        connection.finish(pidid)
+        connection.finish(portid)
+
+        # the UDP endpoint is still there
+        assert sendjson(second.rpcport, {"method": "getport"})["port"] == port
+
+    def test_rafdp_read_ahead(self):
+        first, second = self.first, self.second
+
+        filename = "greatexpectations.txt"
+        roothash = first.addfile(filename)
+        assert second.addpeer("127.0.0.1", first.getport())
+        assert second.addhash(roothash)
+        with open(filename, "rb") as file:
+            data = file.read()
+
+        readahead = ReadAhead(second, roothash, minwindow=2, maxwindow=8)
+        gathereddata = b"".join(readahead.read(offset, 32768) for offset in range(0, len(data), 32768))
+        assert gathereddata == data
+        assert readahead.window == 8
+
+        # random access shrinks the window again
+        assert readahead.read(12345, 100) == data[12345:12445]
+        assert readahead.window == 4
+        readahead.close()
+
+def test_rafdp_asyncio_engine():
+    threaded = RAFDPProcess(7286)
+    asyncioengine = RAFDPProcess(7287, engine="asyncio")
+
+    time.sleep(2)
+
+    try:
+        # asyncio engine downloading from the threaded engine
+        thehash = threaded.addfile("cat.jpg")
+        assert asyncioengine.addpeer("127.0.0.1", threaded.getport())
+        assert asyncioengine.addhash(thehash)
+        chunksize, lastchunksize, numchunks, estfilesize = asyncioengine.gethashstats(thehash)
+        with open("cat.jpg", "rb") as file:
+            assert asyncioengine.getsizeoffsetfromhash(thehash, estfilesize, 0) == file.read()
+
+        # and the other way around
+        thehash = asyncioengine.addfile("greatexpectations.txt")
+        assert threaded.addpeer("127.0.0.1", asyncioengine.getport())
+        assert threaded.addhash(thehash)
+        size, offset = generate_test_range(os.path.getsize("greatexpectations.txt"), chunksize, condition=1)
+        with open("greatexpectations.txt", "rb") as file:
+            file.seek(offset)
+            assert threaded.getsizeoffsetfromhash(thehash, size, offset) == file.read(size)
+    finally:
+        threaded.close()
+        asyncioengine.close()
+
+def test_rafdp_resume_download():
+    seeder = RAFDPProcess(7288)
+    downloader = RAFDPProcess(7289)
+    with open("cat.jpg", "rb") as file:
+        data = file.read()
+
+    time.sleep(2)
+
+    try:
+        try:
+            roothash = seeder.addfile("cat.jpg")
+            assert downloader.addpeer("127.0.0.1", seeder.getport())
+            assert downloader.addhash(roothash)
+            assert downloader.readrange(roothash, 0, len(data), timeout=60) == data
+            # wait for the download state to be saved
+            time.sleep(3)
+        finally:
+            downloader.close()
+
+        # started again without any peers, so everything has to come from the saved state
+        downloader = RAFDPProcess(7289)
+        time.sleep(2)
+        try:
+            assert downloader.readrange(roothash, 0, len(data), timeout=10) == data
+        finally:
+            downloader.close()
+    finally:
+        seeder.close()
+
+def test_rafdp_peer_exchange():
+    seeder = RAFDPProcess(7290)
+    first = RAFDPProcess(7291)
+    second = RAFDPProcess(7292)
+
+    time.sleep(2)
+
+    try:
+        roothash = seeder.addfile("cat.jpg")
+        seederport = seeder.getport()
+        for downloader in (first, second):
+            assert downloader.addhash(roothash)
+            assert downloader.addpeer("127.0.0.1", seederport)
+        # the downloaders only know about the seeder, they find each other through it
+        deadline = time.time() + 20
+        while len(first.getpeers()) < 2 or len(second.getpeers()) < 2:
+            assert time.time() < deadline
+            time.sleep(0.5)
+        assert ["127.0.0.1", second.getport()] in first.getpeers()
+        assert ["127.0.0.1", first.getport()] in second.getpeers()
+    finally:
+        first.close()
+        second.close()
+        seeder.close()
+
 def test_memfs():
     vfs = MemFS()
     vfs.addfile(9963739, "0100444", "videotest.webm")
@@ -236,4 +675,88 @@ def test_rafdp_tracker_support():
     second.close()
 
     server.shutdown()
-    thread.join()
\ No newline at end of file
+    thread.join()
+
+def test_tracker_client_intervals():
+    app = Flask(__name__)
+
+    announces = []
+
+    @app.route("/announce")
+    def announce():
+        infohash = request.args["info_hash"]
+        announces.append(infohash)
+        # the first torrent isn't due again for a minute, the second one is due straight away
+        interval = 60 if infohash == "A" * 20 else 0
+        response = {b"interval": interval, b"peers": encode_peers([("127.0.0.1", len(announces))])}
+        return bencodepy.encode(response)
+
+    server = make_server("localhost", 7001, app)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    tc = TrackerClient(7002)
+    try:
+        tc.add_url("http://localhost:7001/announce")
+        torrents = [("A" * 20, 0, 0, 100), ("B" * 20, 0, 0, 100)]
+        first = tc.announce_many(torrents)
+        second = tc.announce_many(torrents)
+
+        assert sorted(announces) == ["A" * 20, "B" * 20, "B" * 20]
+        assert first["A" * 20] == second["A" * 20]
+        assert len(second["B" * 20]) == 2
+        assert tc.announce("A" * 20, 0, 0, 100) == first["A" * 20]
+        # a tracker that can't be reached is skipped without failing the other announces
+        tc.add_url("http://localhost:1/announce")
+        assert tc.announce_many(torrents)["A" * 20] == first["A" * 20]
+    finally:
+        tc.close()
+        server.shutdown()
+        thread.join()
+
+def test_tracker_client_udp():
+    # BEP 15 tracker stand-in, the first connect is dropped so the client has to retry
+    received = []
+    peerlists = {}
+
+    class UDPTrackerHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            data, sock = self.request
+            action, transaction = struct.unpack("!II", data[8:16])
+            received.append(action)
+            if action == 0:
+                if received.count(0) == 1:
+                    return
+                sock.sendto(struct.pack("!IIQ", 0, transaction, 1234), self.client_address)
+            elif action == 1:
+                connectionid, = struct.unpack("!Q", data[:8])
+                if connectionid != 1234:
+                    sock.sendto(struct.pack("!II", 3, transaction) + b"bad connection id", self.client_address)
+                    return
+                infohash = data[16:36]
+                port, = struct.unpack("!H", data[96:98])
+                peers = encode_peers(peerlists.get(infohash, []))
+                peerlists.setdefault(infohash, []).append(("127.0.0.1", port))
+                sock.sendto(struct.pack("!IIIII", 1, transaction, 0, 0, 0) + peers, self.client_address)
+
+    server = socketserver.ThreadingUDPServer(("127.0.0.1", 7003), UDPTrackerHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    first = TrackerClient(7004)
+    second = TrackerClient(7005)
+    try:
+        for tc in (first, second):
+            tc.udptimeout = 0.2
+            tc.add_url("udp://127.0.0.1:7003")
+        assert first.announce("A" * 20, 0, 0, 100) == set()
+        assert second.announce("A" * 20, 0, 0, 100) == {("127.0.0.1", 7004)}
+        assert second.announce_many([("B" * 20, 0, 0, 100)]) == {"B" * 20: set()}
+        # one dropped connect, one connect per client and an announce each time (the connection id is reused)
+        assert received == [0, 0, 1, 0, 1, 1]
+    finally:
+        first.close()
+        second.close()
+        server.shutdown()
+        thread.join()
+        server.server_close()
@@ -2,7 +2,12 @@ import requests
 import string
 import random
 import time
+import threading
+import socket
+import struct
 import bencodepy
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 from multiprocessing.pool import ThreadPool
 from utils import decode_peers
 
@@ -11,20 +16,54 @@ peeridchars = string.ascii_letters + string.digits
 def generate_peerid():
     return "".join(random.choice(peeridchars) for _ in range(20))
 
+# UDP tracker protocol (BEP 15)
+udpprotocolid = 0x41727101980
+CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+udpevents = {None: 0, "completed": 1, "started": 2, "stopped": 3}
+connectrequest = struct.Struct("!QII")
+announcerequest = struct.Struct("!QII20s20sQQQIIIiH")
+
 class TrackerClient:
+    # Announces go through one long-lived pool of workers (one tracker url per worker at a time)
+    # over a shared session, so connections to each tracker are kept alive between announces
+    workers = 8
+    # a udp tracker is asked again after udptimeout * 2 ** attempt seconds, BEP 15 allows up to 8 retries
+    # but a tracker that doesn't answer within a few shouldn't hold up a worker for an hour
+    udptimeout = 15
+    udpretries = 2
+    # connection ids given by udp trackers can be reused for a minute
+    connectionidlifetime = 60
+
     def __init__(self, port, peer_id=None):
         self.port = port
         if peer_id is None:
             peer_id = generate_peerid()
         self.peer_id = peer_id
 
-        self.urls = {}
+        self.lock = threading.Lock()
+        self.urls = set()
         self.infohashes = {}
+        # (url, infohash) -> {"interval": ..., "lastcontacted": ...}
+        self.announces = {}
+        # (url, infohash) pairs currently being announced
+        self.inflight = set()
+        # (host, port) of udp trackers -> (connection id, time it was given)
+        self.connections = {}
+        self.key = random.getrandbits(32)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = None
 
         self.compact = True
         self.no_peer_id = True
 
     def _announce(self, url, info_hash, uploaded, downloaded, left, event=None):
+        if url.startswith("udp://"):
+            return self._announce_udp(url, info_hash, uploaded, downloaded, left, event)
+
         params = {
             "info_hash": info_hash[0:20],
             "peer_id": self.peer_id,
@@ -39,47 +78,129 @@ class TrackerClient:
         if event is not None:
             params["event"] = event
 
-        try:
-            r = requests.get(url, params=params, timeout=10)
-            result = bencodepy.decode(r.content)
-            result[b"peers"] = decode_peers(result[b"peers"])
-            result[b"url"] = url
-        except KeyboardInterrupt as e:
-            raise e
-        except Exception:
-            result = None
+        r = self.session.get(url, params=params, timeout=10)
+        result = bencodepy.decode(r.content)
+        result[b"peers"] = decode_peers(result[b"peers"])
+        result[b"url"] = url
         return result
 
+    def _announce_udp(self, url, info_hash, uploaded, downloaded, left, event=None):
+        parts = urlsplit(url)
+        address = (parts.hostname, parts.port)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for attempt in range(self.udpretries + 1):
+                sock.settimeout(self.udptimeout * 2 ** attempt)
+                try:
+                    connectionid = self._udp_connect(sock, address)
+                    transaction = random.getrandbits(32)
+                    packet = announcerequest.pack(connectionid, ANNOUNCE, transaction, info_hash[0:20].encode("ascii"), self.peer_id.encode("ascii"),
+                                                  downloaded, left, uploaded, udpevents[event], 0, self.key, -1, self.port)
+                    response = self._udp_exchange(sock, address, packet, ANNOUNCE, transaction)
+                except socket.timeout:
+                    # the connection id may have expired on the tracker's side, so connect again too
+                    with self.lock:
+                        self.connections.pop(address, None)
+                    continue
+                interval, leechers, seeders = struct.unpack("!III", response[:12])
+                return {b"interval": interval, b"incomplete": leechers, b"complete": seeders,
+                        b"peers": decode_peers(response[12:]), b"url": url}
+        raise ConnectionError(f"No response from {url}")
+
+    def _udp_connect(self, sock, address):
+        with self.lock:
+            cached = self.connections.get(address)
+        if cached is not None and (time.monotonic() - cached[1]) < self.connectionidlifetime:
+            return cached[0]
+        transaction = random.getrandbits(32)
+        response = self._udp_exchange(sock, address, connectrequest.pack(udpprotocolid, CONNECT, transaction), CONNECT, transaction)
+        connectionid, = struct.unpack("!Q", response[:8])
+        with self.lock:
+            self.connections[address] = (connectionid, time.monotonic())
+        return connectionid
+
+    def _udp_exchange(self, sock, address, packet, action, transaction):
+        # Sends packet and returns what follows the action and transaction id of the matching response
+        sock.sendto(packet, address)
+        while True:
+            data, _ = sock.recvfrom(65536)
+            if len(data) < 8:
+                continue
+            gotaction, gottransaction = struct.unpack("!II", data[:8])
+            if gottransaction != transaction:
+                continue
+            if gotaction == ERROR:
+                raise Exception(f"Tracker error: {data[8:].decode('utf-8', 'replace')}")
+            if gotaction == action:
+                return data[8:]
+
+    def _announce_url(self, url, torrents, event):
+        # Announces every torrent due for one tracker, giving up on the rest if the tracker can't be reached
+        results = []
+        for infohash, uploaded, downloaded, left in torrents:
+            try:
+                result = self._announce(url, infohash, uploaded, downloaded, left, event)
+            except KeyboardInterrupt as e:
+                raise e
+            except (requests.ConnectionError, ConnectionError):
+                break
+            except Exception:
+                continue
+            results.append((infohash, result))
+        return url, torrents, results
+
+    def due(self, url, infohash, now):
+        values = self.announces.get((url, infohash))
+        if values is None:
+            return True
+        return (now - values["lastcontacted"]) >= values["interval"]
+
+    def announce_many(self, torrents, event=None):
+        # torrents is a list of (infohash, uploaded, downloaded, left),
+        # returns infohash -> every peer that trackers have given for it
+        torrents = [(infohash[0:20], *values) for infohash, *values in torrents]
+        now = time.time()
+        batches = {}
+        with self.lock:
+            for infohash, *values in torrents:
+                self.infohashes.setdefault(infohash, set())
+                for url in self.urls:
+                    if (url, infohash) not in self.inflight and self.due(url, infohash, now):
+                        self.inflight.add((url, infohash))
+                        batches.setdefault(url, []).append((infohash, *values))
+            if batches and self.pool is None:
+                self.pool = ThreadPool(self.workers)
+
+        if batches:
+            try:
+                batchresults = self.pool.starmap(self._announce_url, [(url, batch, event) for url, batch in batches.items()])
+            finally:
+                with self.lock:
+                    for url, batch in batches.items():
+                        self.inflight.difference_update((url, infohash) for infohash, *_ in batch)
+
+            with self.lock:
+                for url, batch, results in batchresults:
+                    for infohash, result in results:
+                        self.infohashes[infohash].update(result[b"peers"])
+                        if b"min interval" in result:
+                            interval = result[b"min interval"]
+                        else:
+                            interval = result[b"interval"]
+                        self.announces[(url, infohash)] = {"interval": interval, "lastcontacted": time.time()}
+
+        with self.lock:
+            return {infohash: set(self.infohashes[infohash]) for infohash, *_ in torrents}
+
     def announce(self, infohash, uploaded, downloaded, left, event=None):
-        infohash = infohash[0:20]
-        if infohash not in self.infohashes:
-            self.infohashes[infohash] = set()
-
-        function = lambda url: self._announce(url, infohash, uploaded, downloaded, left, event)
-
-        filteredurls = []
-        for url, values in self.urls.items():
-            if values["lastcontacted"] is None:
-                filteredurls.append(url)
-            else:
-                if (time.time() - values["lastcontacted"]) >= values["interval"]:
-                    filteredurls.append(url)
-
-        with ThreadPool(8) as pool:
-            results = pool.map(function, filteredurls)
-
-        for result in results:
-            if result is not None:
-                self.infohashes[infohash].update(result[b"peers"])
-                if b"min interval" in result:
-                    interval = result[b"min interval"]
-                else:
-                    interval = result[b"interval"]
-                self.urls[result[b"url"]]["interval"] = interval
-                self.urls[result[b"url"]]["lastcontacted"] = time.time()
-
-        return self.infohashes[infohash]
+        return self.announce_many([(infohash, uploaded, downloaded, left)], event)[infohash[0:20]]
 
     def add_url(self, url):
-        if url not in self.urls:
-            self.urls[url] = {"interval": None, "lastcontacted": None}
+        with self.lock:
+            self.urls.add(url)
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.terminate()
+        self.session.close()
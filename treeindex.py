@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import threading
+from array import array
+from core import FileTree, Interior
+
+
+def filestat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+class TreeIndex:
+    version = 2
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(filename), check_same_thread=False)
+        with self.lock, self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != self.version:
+                # indexes from older versions are thrown away, those files are rehashed instead
+                self.connection.execute("DROP TABLE IF EXISTS nodes")
+                self.connection.execute("DROP TABLE IF EXISTS levels")
+                self.connection.execute("DROP TABLE IF EXISTS files")
+                self.connection.execute(f"PRAGMA user_version = {self.version}")
+            # the sorted digest prefixes (and which node they belong to) are stored so they don't need sorting again
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, roothash TEXT, prefixes BLOB, nodeids BLOB)")
+            # the concatenated digests of each level of the tree
+            self.connection.execute("CREATE TABLE IF NOT EXISTS levels (path TEXT, level INTEGER, digests BLOB)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS levelspath ON levels (path)")
+            # root hashes being downloaded and the interior nodes received for them (leaves are in the blob store)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS downloads (roothash TEXT PRIMARY KEY)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS downloadnodes (hash BLOB PRIMARY KEY, value BLOB)")
+
+    def add(self, path, roothash, filetree, stat):
+        rows = [(path, level, bytes(digests)) for level, digests in enumerate(filetree.levels)]
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM levels WHERE path = ?", (path,))
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", (path, *stat, roothash, filetree.prefixes.tobytes(), filetree.nodeids.tobytes()))
+            self.connection.executemany("INSERT INTO levels VALUES (?, ?, ?)", rows)
+
+    def remove(self, path):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM levels WHERE path = ?", (path,))
+            self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def files(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT path FROM files").fetchall()
+        return [path for path, in rows]
+
+    def lookup(self, path):
+        # Returns the root hash of path if it has been indexed and hasn't changed since
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime, inode, roothash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        *stat, roothash = row
+        try:
+            if filestat(path) != tuple(stat):
+                return None
+        except OSError:
+            return None
+        return roothash
+
+    def load(self, path, chunk_size):
+        with self.lock:
+            prefixes, nodeids = self.connection.execute("SELECT prefixes, nodeids FROM files WHERE path = ?", (path,)).fetchone()
+            rows = self.connection.execute("SELECT digests FROM levels WHERE path = ? ORDER BY level", (path,)).fetchall()
+        return FileTree(path, chunk_size, [digests for digests, in rows], array("Q", prefixes), array("I", nodeids))
+
+    def add_download(self, roothash):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO downloads VALUES (?)", (roothash,))
+
+    def downloads(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT roothash FROM downloads").fetchall()
+        return [roothash for roothash, in rows]
+
+    def add_nodes(self, nodes):
+        # nodes is a list of (digest, interior node)
+        rows = [(key, node.first + (node.second or b"")) for key, node in nodes]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO downloadnodes VALUES (?, ?)", rows)
+
+    def download_nodes(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT hash, value FROM downloadnodes").fetchall()
+        return {key: Interior(value[:32], value[32:] or None) for key, value in rows}
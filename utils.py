@@ -16,9 +16,54 @@ def tovarint(integer):
     
 def fromvarint(data):
     length, data = int(chr(data[0]), 16), data[1:]
-    integer, leftover = int(data[0:length].decode("ascii"), 16), data[length:]
+    integer, leftover = int(bytes(data[0:length]), 16), data[length:]
     return integer, leftover
 
+B58ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+B58INDEX = {character: value for value, character in enumerate(B58ALPHABET)}
+
+def tobase58(data):
+    # bitcoin base58 alphabet, leading zero bytes are kept as leading "1"s
+    integer = int.from_bytes(data, "big")
+    encoded = []
+    while integer:
+        integer, remainder = divmod(integer, 58)
+        encoded.append(B58ALPHABET[remainder])
+    padding = len(data) - len(data.lstrip(b"\x00"))
+    return "1" * padding + "".join(reversed(encoded))
+
+def frombase58(text):
+    integer = 0
+    for character in text:
+        if character not in B58INDEX:
+            raise ValueError(f"{character!r} is not a base58 character")
+        integer = integer * 58 + B58INDEX[character]
+    padding = len(text) - len(text.lstrip("1"))
+    return b"\x00" * padding + integer.to_bytes((integer.bit_length() + 7) // 8, "big")
+
+# length of the payload, request id and type of a message over a persistent RPC connection
+messageheader = struct.Struct("!IIB")
+REQUEST, RESPONSE, DATA, END = range(4)
+
+def tomessage(requestid, messagetype, payload):
+    return messageheader.pack(len(payload), requestid, messagetype) + payload
+
+def sendmessage(sock, requestid, messagetype, payload):
+    sock.sendall(tomessage(requestid, messagetype, payload))
+
+def recvexactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        received = sock.recv(size - len(data))
+        if not received:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        data += received
+    return bytes(data)
+
+def recvmessage(sock):
+    length, requestid, messagetype = messageheader.unpack(recvexactly(sock, messageheader.size))
+    return requestid, messagetype, recvexactly(sock, length)
+
 def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
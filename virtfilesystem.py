@@ -23,7 +23,7 @@ import threading
 import json
 import ctypes
 
-from rafdplib import RAFDPProcess
+from rafdplib import RAFDPProcess, ReadAhead
 from utils import MemFS
 
 def findrafdpfilesize(thehash):
@@ -90,21 +90,25 @@ class VFSServer(ServerInterface):
 class StubSFTPHandle(SFTPHandle):
     def __init__(self, filehash):
         self.filehash = filehash
+        self.readahead = None
+        if filehash.startswith("RAFDP"):
+            self.readahead = ReadAhead(rafdpdaemon, filehash, maxwindow=readaheadwindow)
 
     def read(self, offset, length):
         filehash = self.filehash
-        if filehash.startswith("RAFDP"):
-            result = rafdpdaemon.getsizeoffsetfromhash(filehash, length, offset)
-            while result is None:
-                time.sleep(0.01)
-                result = rafdpdaemon.getsizeoffsetfromhash(filehash, length, offset)
-            return result
+        if self.readahead is not None:
+            return self.readahead.read(offset, length)
         else:
             result = subprocess.run(["ipfs", "cat", filehash, "-o", str(offset), "-l", str(length)], stdout=subprocess.PIPE)
             if result.returncode != 0:
                 raise Exception(result)
             return result.stdout
 
+    def close(self):
+        if self.readahead is not None:
+            self.readahead.close()
+        super().close()
+
 class VFSSFTPServer(SFTPServerInterface):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -179,7 +183,9 @@ if __name__ == '__main__':
     parser.add_argument("rpcport", type=int, nargs="?", default=7274, help="RPC port")
     parser.add_argument("rafdpport", type=int, nargs="?", default=7275, help="RAFDP port")
     parser.add_argument("path", type=str, nargs="?", default="./test", help="Path to place virtual filesystem")
+    parser.add_argument("--readahead", type=int, default=64, help="Maximum number of chunks prefetched after sequential reads of a file")
     args = parser.parse_args()
+    readaheadwindow = args.readahead
 
     logname = Path(tempfile.gettempdir()) / "rafdp" / "logs" / (str(args.rpcport) + ".log")
     logname.parent.mkdir(parents=True, exist_ok=True)